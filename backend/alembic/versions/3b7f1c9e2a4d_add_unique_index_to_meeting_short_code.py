@@ -0,0 +1,29 @@
+"""Add unique index to meeting short_code
+
+Revision ID: 3b7f1c9e2a4d
+Revises: d579feca9eb6
+Create Date: 2026-10-18 09:12:31.482915+00:00
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "3b7f1c9e2a4d"
+down_revision: Union[str, None] = "d579feca9eb6"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_index(
+        op.f("ix_meeting_short_code"), "meeting", ["short_code"], unique=True
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(op.f("ix_meeting_short_code"), table_name="meeting")
@@ -0,0 +1,65 @@
+"""Add meeting event log and checkpoints
+
+Revision ID: 5e8a2c7d9f1b
+Revises: 3b7f1c9e2a4d
+Create Date: 2026-10-18 11:02:47.315208+00:00
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "5e8a2c7d9f1b"
+down_revision: Union[str, None] = "3b7f1c9e2a4d"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        "meeting_event",
+        sa.Column("id", sa.BigInteger(), sa.Identity(always=False), nullable=False),
+        sa.Column("meeting_id", sa.Uuid(), nullable=False),
+        sa.Column("payload", postgresql.JSONB(), nullable=False),
+        sa.Column(
+            "created_at", sa.DateTime(), server_default=sa.text("now()"), nullable=False
+        ),
+        sa.ForeignKeyConstraint(["meeting_id"], ["meeting.id"], ondelete="CASCADE"),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index(
+        "ix_meeting_event_meeting_id_id", "meeting_event", ["meeting_id", "id"]
+    )
+    op.create_table(
+        "meeting_checkpoint",
+        sa.Column("id", sa.BigInteger(), sa.Identity(always=False), nullable=False),
+        sa.Column("meeting_id", sa.Uuid(), nullable=False),
+        sa.Column("last_event_id", sa.BigInteger(), nullable=True),
+        sa.Column("state", postgresql.JSONB(), nullable=False),
+        sa.Column(
+            "created_at", sa.DateTime(), server_default=sa.text("now()"), nullable=False
+        ),
+        sa.ForeignKeyConstraint(["meeting_id"], ["meeting.id"], ondelete="CASCADE"),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index(
+        "ix_meeting_checkpoint_meeting_id_id",
+        "meeting_checkpoint",
+        ["meeting_id", "id"],
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(
+        "ix_meeting_checkpoint_meeting_id_id", table_name="meeting_checkpoint"
+    )
+    op.drop_table("meeting_checkpoint")
+    op.drop_index("ix_meeting_event_meeting_id_id", table_name="meeting_event")
+    op.drop_table("meeting_event")
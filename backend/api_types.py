@@ -1,7 +1,9 @@
+import datetime
 import uuid
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
+from channel import CardState
 from models import Role
 
 
@@ -19,6 +21,28 @@ class UpdateRole(BaseModel):
     role: Role
 
 
+class UpdateParticipants(BaseModel):
+    ids: list[uuid.UUID] = Field(min_length=1)
+    role: Role
+
+
+class RemoveParticipants(BaseModel):
+    ids: list[uuid.UUID] = Field(min_length=1)
+
+
+class CreateSimulatedParticipants(BaseModel):
+    count: int = Field(default=1, gt=0, le=1000)
+
+
+class StartLoad(BaseModel):
+    participants: int = Field(gt=0, le=20000)
+    rate: float = Field(gt=0, description="Card changes per second")
+    burst: int = Field(default=1, gt=0, description="Card changes per burst")
+    cards: dict[CardState, float] | None = Field(
+        default=None, description="Relative weight of each card state"
+    )
+
+
 class Meeting(BaseModel):
     short_code: str
     name: str
@@ -40,3 +64,12 @@ class Participation(BaseModel):
 class MeetingResponse(BaseModel):
     meeting: Meeting
     participation: Participation
+
+
+class UserResponse(BaseModel):
+    id: uuid.UUID
+    last_used_name: str | None
+    created_at: datetime.datetime | None
+
+    class Config:
+        from_attributes = True
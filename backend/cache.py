@@ -0,0 +1,54 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+from metrics import CACHE_HITS, CACHE_MISSES
+
+
+class TTLCache:
+    # A bounded, least-recently-used cache whose entries also expire after ttl
+    # seconds. Everything runs on the event loop, so no locking is needed.
+    def __init__(self, name: str, maxsize: int, ttl: float):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self.entries[key]
+            CACHE_MISSES.labels(self.name).inc()
+            return None
+        self.entries.move_to_end(key)
+        CACHE_HITS.labels(self.name).inc()
+        return entry[1]
+
+    def set(self, key, value):
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+
+
+class SingleFlight:
+    # Runs one load per key at a time. Callers that ask for a key while it's
+    # already loading wait for that load instead of starting their own, and a
+    # caller going away doesn't cancel it for the others.
+    def __init__(self):
+        self.loads = {}
+
+    async def run(self, key, load):
+        future = self.loads.get(key)
+        if future is None:
+            future = asyncio.ensure_future(load())
+            self.loads[key] = future
+            future.add_done_callback(lambda _: self.loads.pop(key, None))
+        return await asyncio.shield(future)
@@ -1,6 +1,10 @@
 import asyncio
-import json
 import logging
+import math
+import time
+import uuid
+from bisect import bisect_left, insort
+from collections import OrderedDict, deque
 from dataclasses import dataclass
 from datetime import datetime, timedelta, timezone
 from enum import Enum
@@ -8,9 +12,24 @@ from random import choice
 
 from fastapi import WebSocket, WebSocketException, status
 from sqlalchemy import select
-from sqlalchemy.orm import Session
-
-from models import Meeting, Participation
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from cache import SingleFlight
+from config import settings
+from database import AsyncSessionLocal
+from encoding import JSON, negotiate
+from metrics import (
+    BROADCAST_BYTES,
+    BROADCAST_COOLDOWN,
+    BROADCAST_DURATION,
+    BROADCASTS,
+    BYTES_SENT,
+    CHANNEL_EVENTS,
+    CHANNEL_EVICTIONS,
+    DB_QUERY_DURATION,
+)
+from models import Meeting, Participation, Role
+from pubsub import InProcessBackend
 
 logger = logging.getLogger("uvicorn.error")
 
@@ -35,14 +54,61 @@ class CardState(str, Enum):
 class EventType(Enum):
     CARD_CHANGE = "card_change"
     LOWER_ALL_CARDS = "lower_all_cards"
+    RESYNC = "resync"
+
+
+@dataclass(frozen=True, slots=True)
+class ParticipantRecord:
+    # What a channel needs to know about a participant, copied out of the
+    # Participation row so live meetings don't hold on to ORM objects
+    id: uuid.UUID
+    name: str
+    role: Role
+    simulated: bool
+
+    @staticmethod
+    def of(participation: "Participation | ParticipantRecord"):
+        if isinstance(participation, ParticipantRecord):
+            return participation
+        return ParticipantRecord(
+            id=participation.id,
+            name=participation.name,
+            role=participation.role,
+            simulated=participation.simulated,
+        )
+
+    def to_payload(self):
+        return {
+            "id": str(self.id),
+            "name": self.name,
+            "role": self.role.value,
+            "simulated": self.simulated,
+        }
+
+    @staticmethod
+    def from_payload(payload: dict):
+        return ParticipantRecord(
+            id=uuid.UUID(payload["id"]),
+            name=payload["name"],
+            role=Role(payload["role"]),
+            simulated=payload["simulated"],
+        )
 
 
 @dataclass
 class ChannelEvent(object):
-    participation: Participation
+    participation: ParticipantRecord
 
     @staticmethod
-    def from_payload(session: Session, payload: dict):
+    async def from_payload(
+        channel: "MeetingChannel",
+        payload: dict,
+        bound_pid: uuid.UUID | None = None,
+    ):
+        if not isinstance(payload, dict):
+            raise WebSocketException(
+                code=status.WS_1008_POLICY_VIOLATION, reason="Malformed event"
+            )
         if "event" not in payload:
             raise WebSocketException(
                 code=status.WS_1008_POLICY_VIOLATION, reason="Missing event type"
@@ -52,9 +118,17 @@ class ChannelEvent(object):
             raise WebSocketException(
                 code=status.WS_1008_POLICY_VIOLATION, reason="Missing pid"
             )
-        participation = session.scalars(
-            select(Participation).where(Participation.id == payload.get("pid"))
-        ).first()
+        # Most events come from the participant the connection was opened for,
+        # whose id is parsed once at the handshake and checked against the
+        # roster. Anyone no longer in it, say removed since, goes through the
+        # full lookup, which rejects them once their row is gone.
+        current = None
+        if bound_pid is not None and str(bound_pid) == payload.get("pid"):
+            current = channel.state.participants.get(bound_pid)
+        if current is not None:
+            participation = current.participation
+        else:
+            participation = await channel.resolve_participation(payload.get("pid"))
         if not participation:
             raise WebSocketException(
                 code=status.WS_1008_POLICY_VIOLATION, reason="Unknown user"
@@ -63,6 +137,24 @@ class ChannelEvent(object):
             return CardChangeEvent(
                 participation=participation, state=CardState(payload["state"])
             )
+        if event_type == EventType.LOWER_ALL_CARDS.value:
+            # Roles can change while a connection is open, so check the roster
+            # rather than the record the connection was opened with
+            current = channel.state.participants.get(participation.id)
+            role = current.participation.role if current else participation.role
+            if role != Role.HOST:
+                raise WebSocketException(
+                    code=status.WS_1008_POLICY_VIOLATION,
+                    reason="Only hosts can lower cards",
+                )
+            pids = payload.get("pids")
+            try:
+                pids = None if pids is None else frozenset(map(uuid.UUID, pids))
+            except (TypeError, ValueError) as e:
+                raise WebSocketException(
+                    code=status.WS_1008_POLICY_VIOLATION, reason="Malformed pids"
+                ) from e
+            return LowerAllCardsEvent(participation=participation, pids=pids)
         raise WebSocketException(
             code=status.WS_1008_POLICY_VIOLATION,
             reason=f"Unknown event type: {event_type}",
@@ -73,6 +165,28 @@ class ChannelEvent(object):
 class CardChangeEvent(ChannelEvent):
     state: CardState
 
+    def to_payload(self):
+        return {
+            "event": EventType.CARD_CHANGE.value,
+            "pid": str(self.participation.id),
+            "state": self.state.value,
+        }
+
+
+@dataclass
+class LowerAllCardsEvent(ChannelEvent):
+    # Participants whose cards are lowered, or None for everyone
+    pids: frozenset[uuid.UUID] | None = None
+
+    def to_payload(self):
+        payload = {
+            "event": EventType.LOWER_ALL_CARDS.value,
+            "pid": str(self.participation.id),
+        }
+        if self.pids is not None:
+            payload["pids"] = [str(pid) for pid in self.pids]
+        return payload
+
 
 class Question(Enum):
     UNCHANGED = "unchanged"
@@ -81,7 +195,9 @@ class Question(Enum):
 
 
 class ParticipationState:
-    def __init__(self, participation: Participation):
+    __slots__ = ("participation", "card_state")
+
+    def __init__(self, participation: ParticipantRecord):
         self.participation = participation
         self.card_state = CardState.NONE
 
@@ -96,137 +212,617 @@ class ParticipationState:
         else:
             return Question.UNCHANGED
 
+    def to_dict(self):
+        return {
+            "id": str(self.participation.id),
+            "name": self.participation.name,
+            "role": self.participation.role,
+            "card_state": self.card_state,
+        }
+
+
+def _sort_key(participation: ParticipantRecord):
+    return (participation.name.lower(), participation.id)
+
 
 class MeetingState:
-    def __init__(self, init_participants: list[Participation]):
-        self.participants = {p.id: ParticipationState(p) for p in init_participants}
-        self.questions = []
+    def __init__(self, init_participants: list[Participation | ParticipantRecord]):
+        self.participants = {}
+        # Participant ids with a question card up, in the order they were raised.
+        # Only the keys are used, a dict keeps their order and has O(1) removal.
+        self.questions = {}
+        # Version of the last delta handed out, snapshots are tagged with it so
+        # clients know which delta to expect next
+        self.version = 0
+        self.changes = []
+        # Small stable numbers for participants, used by compact encodings
+        self.indexes = {}
+        self._encoded_snapshots = {}
+        self.set_participants(init_participants)
+        # The initial roster goes out in the first snapshot, not as a delta
+        self.changes = []
+
+    def _record(self, change: dict):
+        self.changes.append(change)
+        self._encoded_snapshots.clear()
+
+    def _assign_index(self, pid):
+        self.indexes.setdefault(str(pid), len(self.indexes))
 
     def set_participants(self, participants):
         old_participants = self.participants
-        self.participants = {p.id: ParticipationState(p) for p in participants}
-        self.questions = [q for q in self.questions if q in self.participants]
-        for pid in self.participants:
-            if pid in old_participants:
-                self.participants[pid].card_state = old_participants[pid].card_state
+        self.participants = {
+            p.id: ParticipationState(ParticipantRecord.of(p)) for p in participants
+        }
+        for pid in old_participants:
+            if pid not in self.participants:
+                self._record({"op": "remove", "id": str(pid)})
+                self.questions.pop(pid, None)
+        for pid, pstate in self.participants.items():
+            if pid not in old_participants:
+                self._assign_index(pid)
+                self._record({"op": "add", "participant": pstate.to_dict()})
+                continue
+            old = old_participants[pid]
+            pstate.card_state = old.card_state
+            if old.participation.name != pstate.participation.name:
+                self._record(
+                    {"op": "rename", "id": str(pid), "name": pstate.participation.name}
+                )
+            if old.participation.role != pstate.participation.role:
+                self._record(
+                    {"op": "role", "id": str(pid), "role": pstate.participation.role}
+                )
+        # Participant index ordered by name, so snapshots don't need a sort
+        self.sorted_index = sorted(
+            _sort_key(p.participation) for p in self.participants.values()
+        )
+
+    def add_participant(self, participation: Participation | ParticipantRecord):
+        participation = ParticipantRecord.of(participation)
+        pid = participation.id
+        if pid in self.participants:
+            # Rejoining, which can change their name
+            self.update_participant(participation)
+            return
+        self.participants[pid] = ParticipationState(participation)
+        self._assign_index(pid)
+        insort(self.sorted_index, _sort_key(participation))
+        self._record({"op": "add", "participant": self.participants[pid].to_dict()})
+
+    def update_participant(self, participation: Participation | ParticipantRecord):
+        participation = ParticipantRecord.of(participation)
+        pid = participation.id
+        pstate = self.participants.get(pid)
+        # Only ever changes participants already in the meeting, adding them is
+        # for joins and reconciliation
+        if pstate is None:
+            return
+        old = pstate.participation
+        pstate.participation = participation
+        if old.name != participation.name:
+            self._remove_sorted(old)
+            insort(self.sorted_index, _sort_key(participation))
+            self._record({"op": "rename", "id": str(pid), "name": participation.name})
+        if old.role != participation.role:
+            self._record({"op": "role", "id": str(pid), "role": participation.role})
+
+    def remove_participant(self, pid: uuid.UUID):
+        pstate = self.participants.pop(pid, None)
+        if pstate is None:
+            return
+        self._remove_sorted(pstate.participation)
+        self.questions.pop(pid, None)
+        self._record({"op": "remove", "id": str(pid)})
+
+    def _remove_sorted(self, participation: ParticipantRecord):
+        key = _sort_key(participation)
+        del self.sorted_index[bisect_left(self.sorted_index, key)]
 
     def apply_event(self, event: ChannelEvent):
-        if event.participation.id not in self.participants:
-            self.participants[event.participation.id] = ParticipationState(
-                event.participation
-            )
-        participation_state = self.participants[event.participation.id]
+        if isinstance(event, LowerAllCardsEvent):
+            self.lower_cards(event.pids)
+            return
+        pid = event.participation.id
+        if pid not in self.participants:
+            self.add_participant(event.participation)
+        participation_state = self.participants[pid]
+        old_card_state = participation_state.card_state
         question_change = participation_state.apply_event(event)
-        if (
-            question_change == Question.RAISED
-            and event.participation.id not in self.questions
-        ):
-            self.questions.append(event.participation.id)
-        elif (
-            question_change == Question.LOWERED
-            and event.participation.id in self.questions
-        ):
-            self.questions.remove(event.participation.id)
+        if participation_state.card_state != old_card_state:
+            self._record(
+                {
+                    "op": "card",
+                    "id": str(pid),
+                    "card_state": participation_state.card_state,
+                }
+            )
+        if question_change == Question.RAISED and pid not in self.questions:
+            self.questions[pid] = None
+            self._record({"op": "question_push", "id": str(pid)})
+        elif question_change == Question.LOWERED and pid in self.questions:
+            del self.questions[pid]
+            self._record({"op": "question_pop", "id": str(pid)})
+
+    def lower_cards(self, pids=None):
+        # Only looks at the cards being lowered, and any questions among them
+        # leave the queue in the same transition
+        for pid in self.participants if pids is None else pids:
+            participation_state = self.participants.get(pid)
+            if (
+                participation_state is None
+                or participation_state.card_state == CardState.NONE
+            ):
+                continue
+            participation_state.card_state = CardState.NONE
+            self._record({"op": "card", "id": str(pid), "card_state": CardState.NONE})
+            if pid in self.questions:
+                del self.questions[pid]
+                self._record({"op": "question_pop", "id": str(pid)})
+
+    def checkpoint(self):
+        # Only raised cards, the rest are down
+        return {
+            "cards": {
+                str(pid): pstate.card_state.value
+                for pid, pstate in self.participants.items()
+                if pstate.card_state != CardState.NONE
+            },
+            "questions": [str(pid) for pid in self.questions],
+        }
 
-    def snapshot(self):
-        participants = [
-            {
-                "id": str(p.participation.id),
-                "name": p.participation.name,
-                "role": p.participation.role,
-                "card_state": p.card_state,
-            }
-            for p in self.participants.values()
+    def sync(self, checkpoint: dict):
+        # Brings cards and questions in line with another worker's checkpoint,
+        # recorded as changes since clients may already have a snapshot
+        cards = checkpoint["cards"]
+        for pid, participation_state in self.participants.items():
+            card_state = CardState(cards.get(str(pid), CardState.NONE))
+            if participation_state.card_state != card_state:
+                participation_state.card_state = card_state
+                self._record({"op": "card", "id": str(pid), "card_state": card_state})
+        questions = [
+            pid
+            for pid in map(uuid.UUID, checkpoint["questions"])
+            if pid in self.participants
         ]
-        participants.sort(key=lambda x: x["name"].lower())
+        if list(self.questions) != questions:
+            for pid in self.questions:
+                self._record({"op": "question_pop", "id": str(pid)})
+            self.questions = dict.fromkeys(questions)
+            for pid in questions:
+                self._record({"op": "question_push", "id": str(pid)})
+
+    def restore(self, checkpoint: dict | None, events: list[dict]):
+        # Rebuilds cards and questions from a checkpoint and the events logged
+        # after it. Nobody has been sent a snapshot yet, so nothing is recorded
+        # as a change. Participants who have since left are skipped.
+        if checkpoint is not None:
+            for pid, card_state in checkpoint["cards"].items():
+                participation_state = self.participants.get(uuid.UUID(pid))
+                if participation_state is not None:
+                    participation_state.card_state = CardState(card_state)
+            for pid in map(uuid.UUID, checkpoint["questions"]):
+                if pid in self.participants:
+                    self.questions[pid] = None
+        for payload in events:
+            if payload["event"] == EventType.CARD_CHANGE.value:
+                participation_state = self.participants.get(uuid.UUID(payload["pid"]))
+                if participation_state is not None:
+                    self.apply_event(
+                        CardChangeEvent(
+                            participation=participation_state.participation,
+                            state=CardState(payload["state"]),
+                        )
+                    )
+            elif payload["event"] == EventType.LOWER_ALL_CARDS.value:
+                pids = payload.get("pids")
+                self.lower_cards(None if pids is None else map(uuid.UUID, pids))
+        self.changes = []
+        self._encoded_snapshots.clear()
+
+    def take_delta(self):
+        # Every change is an idempotent "set", so a client whose snapshot
+        # already includes some of them can safely apply them again
+        if not self.changes:
+            return None
+        self.version += 1
+        delta = {"type": "delta", "version": self.version, "changes": self.changes}
+        self.changes = []
+        self._encoded_snapshots.clear()
+        return delta
+
+    def snapshot(self):
         return {
-            "participants": participants,
+            "type": "snapshot",
+            "version": self.version,
+            "participants": [
+                self.participants[pid].to_dict() for _, pid in self.sorted_index
+            ],
             "questions": [str(p) for p in self.questions],
         }
 
+    def encoded_snapshot(self, encoding=JSON):
+        # Encoded once per change and shared by every connection that needs it
+        if encoding.name not in self._encoded_snapshots:
+            self._encoded_snapshots[encoding.name] = encoding.encode_snapshot(
+                self, self.snapshot()
+            )
+        return self._encoded_snapshots[encoding.name]
+
+
+class Connection:
+    # Each websocket gets its own outbound queue and writer task, so a client on
+    # a slow network only holds up its own updates
+    def __init__(self, channel: "MeetingChannel", websocket: WebSocket, encoding=JSON):
+        self.channel = channel
+        self.websocket = websocket
+        self.encoding = encoding
+        self.bytes_sent = BYTES_SENT.labels(encoding.name)
+        self.queue = deque()
+        self.needs_snapshot = False
+        self.wakeup = asyncio.Event()
+        self.writer_task = asyncio.create_task(self._write_loop())
+
+    def send(self, message: str | bytes):
+        if len(self.queue) >= settings.WS_SEND_QUEUE_SIZE:
+            logger.debug(
+                "Send queue full on %s, falling back to snapshot", self.channel
+            )
+            self.send_snapshot()
+            return
+        self.queue.append(message)
+        self.wakeup.set()
+
+    def send_snapshot(self):
+        # The snapshot is encoded when it's written, so it supersedes anything
+        # still queued
+        self.queue.clear()
+        self.needs_snapshot = True
+        self.wakeup.set()
+
+    def close(self):
+        if self.writer_task is not asyncio.current_task():
+            self.writer_task.cancel()
+
+    async def _write_loop(self):
+        try:
+            while True:
+                await self.wakeup.wait()
+                self.wakeup.clear()
+                while self.needs_snapshot or self.queue:
+                    if self.needs_snapshot:
+                        self.needs_snapshot = False
+                        message = self.channel.state.encoded_snapshot(self.encoding)
+                    else:
+                        message = self.queue.popleft()
+                    async with asyncio.timeout(settings.WS_SEND_TIMEOUT):
+                        if isinstance(message, bytes):
+                            await self.websocket.send_bytes(message)
+                        else:
+                            await self.websocket.send_text(message)
+                    self.bytes_sent.inc(len(message))
+        except asyncio.CancelledError:
+            return
+        except TimeoutError:
+            logger.info("Disconnecting stalled client from %s", self.channel)
+        except Exception:
+            logger.exception("Error sending to client from %s", self.channel)
+        self.channel.remove_connection(self.websocket)
+        try:
+            async with asyncio.timeout(settings.WS_SEND_TIMEOUT):
+                await self.websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        except Exception:
+            logger.debug("Failed to close websocket cleanly", exc_info=True)
+
 
 class MeetingChannel:
-    SNAPSHOT_COOLDOWN = timedelta(seconds=1)
     SIMULATED_EVENT_INTERVAL = timedelta(seconds=5)
-
-    def __init__(self, meeting: Meeting, init_participants: list[Participation]):
+    # Time constant of the event rate average, in seconds
+    EVENT_RATE_WINDOW = 10
+
+    def __init__(
+        self,
+        meeting: Meeting,
+        init_participants: list[Participation | ParticipantRecord],
+        backend=None,
+        event_log=None,
+    ):
         self.meeting = meeting
-        self.websockets = []
+        self.backend = backend or InProcessBackend()
+        self.event_log = event_log
+        self.events_since_checkpoint = 0
+        self.connections = {}
         self.state = MeetingState(init_participants)
-        self.last_snapshot_sent_at = datetime.min.replace(tzinfo=timezone.utc)
-        self.last_snapshot_hash = None
-        self.delayed_snapshot_task = None
+        # Monotonic time the roster was last loaded in full
+        self.roster_loaded_at = time.monotonic()
+        # Bumped by every add, update and removal, so a reload can tell the
+        # roster changed while it was being read
+        self.roster_generation = 0
+        self.last_broadcast_at = datetime.min.replace(tzinfo=timezone.utc)
+        # Exponentially weighted events per second, as of event_rate_at
+        self.event_rate = 0.0
+        self.event_rate_at = time.monotonic()
+        # Labelled by id, since the short code is all it takes to join, and
+        # metrics aren't secret
+        self.cooldown_gauge = BROADCAST_COOLDOWN.labels(str(meeting.id))
+        self.delayed_broadcast_task = None
         self.simulated_event_task = None
+        # Set while a loadgen.LoadGenerator is running against this channel
+        self.load_generator = None
+        # Monotonic time the last connection left, None while anyone is connected
+        self.idle_since = time.monotonic()
+        # Websocket handshakes holding this channel before their connection is
+        # added, which keep it from being evicted
+        self.handshakes = 0
+        # Until this channel has seen any events, it takes the state of the
+        # meeting from other workers that have
+        self.needs_sync = True
 
     async def add_connection(self, websocket: WebSocket):
-        await websocket.accept()
-        self.websockets.append(websocket)
+        encoding, subprotocol = negotiate(websocket.scope.get("subprotocols", []))
+        await websocket.accept(subprotocol=subprotocol)
+        self.connections[websocket] = Connection(self, websocket, encoding)
+        self.idle_since = None
         self._maybe_start_simulated_task()
 
     def remove_connection(self, websocket: WebSocket):
-        self.websockets.remove(websocket)
-        if len(self.websockets) == 0 and self.simulated_event_task is not None:
-            self.simulated_event_task.cancel()
-            self.simulated_event_task = None
-
-    async def refresh_participants(self, session: Session):
-        participants = session.scalars(
-            select(Participation).where(Participation.meeting == self.meeting)
+        connection = self.connections.pop(websocket, None)
+        if connection is not None:
+            connection.close()
+        if len(self.connections) == 0:
+            self.idle_since = time.monotonic()
+            if self.simulated_event_task is not None:
+                self.simulated_event_task.cancel()
+                self.simulated_event_task = None
+
+    def is_idle(self):
+        return len(self.connections) == 0 and self.handshakes == 0
+
+    def close(self):
+        for websocket in list(self.connections):
+            self.remove_connection(websocket)
+        for task in (self.delayed_broadcast_task, self.simulated_event_task):
+            if task is not None:
+                task.cancel()
+        if self.load_generator is not None:
+            self.load_generator.cancel()
+            self.load_generator = None
+        self.delayed_broadcast_task = None
+        self.simulated_event_task = None
+        BROADCAST_COOLDOWN.remove(str(self.meeting.id))
+
+    def count_events(self, count: int, now: float | None = None):
+        now = time.monotonic() if now is None else now
+        self.event_rate = self.current_event_rate(now) + count / self.EVENT_RATE_WINDOW
+        self.event_rate_at = now
+
+    def current_event_rate(self, now: float | None = None):
+        now = time.monotonic() if now is None else now
+        elapsed = now - self.event_rate_at
+        return self.event_rate * math.exp(-elapsed / self.EVENT_RATE_WINDOW)
+
+    def broadcast_cooldown(self, now: float | None = None):
+        # Small or quiet meetings broadcast as soon as the floor allows. Once
+        # every event going out to every connection would blow the message
+        # budget, space broadcasts so each one fits within it instead.
+        connections = len(self.connections)
+        budget = settings.BROADCAST_MESSAGE_BUDGET
+        if self.current_event_rate(now) * connections <= budget:
+            cooldown = settings.BROADCAST_COOLDOWN_MIN
+        else:
+            cooldown = connections / budget
+        cooldown = min(
+            max(cooldown, settings.BROADCAST_COOLDOWN_MIN),
+            settings.BROADCAST_COOLDOWN_MAX,
         )
+        self.cooldown_gauge.set(cooldown)
+        return timedelta(seconds=cooldown)
+
+    async def refresh_participants(self, session: AsyncSession):
+        generation = self.roster_generation
+        with DB_QUERY_DURATION.labels("roster").time():
+            participants = list(
+                await session.scalars(
+                    select(Participation).where(Participation.meeting == self.meeting)
+                )
+            )
+        if self.roster_generation != generation:
+            # The result may predate changes applied while it was read, and
+            # would undo them. The next sweep tries again, as the roster is
+            # still due a reload.
+            return
+        if self.load_generator is not None:
+            # Load participants have no rows, so keep them across reloads
+            participants += self.load_generator.participants
         self.state.set_participants(participants)
-        await self.broadcast_snapshot_with_cooldown()
+        self.roster_loaded_at = time.monotonic()
+        await self.broadcast_changes_with_cooldown()
         self._maybe_start_simulated_task()
 
-    async def handle_event(self, event: ChannelEvent):
-        self.state.apply_event(event)
-        await self.broadcast_snapshot_with_cooldown()
-
-    async def send_snapshot(self, websocket: WebSocket):
-        snapshot = self.state.snapshot()
-        await websocket.send_json(snapshot)
-
-    async def _broadcast_snapshot_if_changed(self):
-        if len(self.websockets) > 0:
-            snapshot = self.state.snapshot()
-            snapshot_json = json.dumps(snapshot)
-            snapshot_hash = hash(snapshot_json)
-            if self.last_snapshot_hash == snapshot_hash:
-                logger.debug("Snapshot unchanged, skipping snapshot broadcast")
-                return
-            tasks = [
-                websocket.send_text(snapshot_json) for websocket in self.websockets
+    async def add_participants(
+        self,
+        participations: list[Participation | ParticipantRecord],
+        publish: bool = True,
+    ):
+        records = [ParticipantRecord.of(p) for p in participations]
+        for record in records:
+            self.state.add_participant(record)
+        await self._roster_changed(
+            {"op": "add", "participants": [r.to_payload() for r in records]},
+            publish,
+            any(r.simulated for r in records),
+        )
+
+    async def update_participants(
+        self,
+        participations: list[Participation | ParticipantRecord],
+        publish: bool = True,
+    ):
+        records = [ParticipantRecord.of(p) for p in participations]
+        for record in records:
+            self.state.update_participant(record)
+        await self._roster_changed(
+            {"op": "update", "participants": [r.to_payload() for r in records]},
+            publish,
+            any(r.simulated for r in records),
+        )
+
+    async def remove_participants(self, pids: list[uuid.UUID], publish: bool = True):
+        simulated = False
+        for pid in pids:
+            pstate = self.state.participants.get(pid)
+            simulated = simulated or (
+                pstate is not None and pstate.participation.simulated
+            )
+            self.state.remove_participant(pid)
+        await self._roster_changed(
+            {"op": "remove", "ids": [str(pid) for pid in pids]}, publish, simulated
+        )
+
+    async def _roster_changed(self, change: dict, publish: bool, simulated: bool):
+        # One message to other workers and one broadcast however many
+        # participants changed. Other workers apply the same change to their
+        # copy of the roster.
+        self.roster_generation += 1
+        if publish:
+            self.backend.publish(self.meeting.short_code, {"type": "roster", **change})
+        await self.broadcast_changes_with_cooldown()
+        # Looking for simulated participants is a scan, so only when one changed
+        if simulated:
+            self._maybe_start_simulated_task()
+
+    async def resolve_participation(self, pid):
+        try:
+            pid = uuid.UUID(str(pid))
+        except ValueError:
+            return None
+        if pid in self.state.participants:
+            return self.state.participants[pid].participation
+        logger.debug("Participant %s not in roster, falling back to database", pid)
+        # Only hold a pooled connection for as long as the lookup takes
+        async with AsyncSessionLocal() as session:
+            with DB_QUERY_DURATION.labels("participation").time():
+                results = await session.scalars(
+                    select(Participation).where(
+                        Participation.id == pid,
+                        Participation.meeting_id == self.meeting.id,
+                    )
+                )
+            participation = results.first()
+        return ParticipantRecord.of(participation) if participation else None
+
+    async def handle_event(self, event: ChannelEvent, publish: bool = True):
+        await self.handle_events([event], publish)
+
+    async def handle_events(self, events: list[ChannelEvent], publish: bool = True):
+        # Applied as one change to the meeting, with one broadcast decision and
+        # one message to other workers however many events there are
+        for event in events:
+            self.state.apply_event(event)
+        self.needs_sync = False
+        self.count_events(len(events))
+        if publish:
+            # Only the worker an event arrived on logs it, and only that worker
+            # checkpoints it, as its checkpoints are stamped with its own last
+            # logged event
+            self.events_since_checkpoint += len(events)
+            payloads = [event.to_payload() for event in events]
+            self.backend.publish(
+                self.meeting.short_code, {"type": "events", "events": payloads}
+            )
+            if self.event_log is not None:
+                self.event_log.append(self.meeting.id, payloads)
+        await self.broadcast_changes_with_cooldown()
+
+    def checkpoint(self):
+        if self.event_log is not None and self.events_since_checkpoint:
+            self.event_log.checkpoint(self.meeting.id, self.state.checkpoint())
+            self.events_since_checkpoint = 0
+
+    async def handle_remote_message(self, message: dict):
+        # Already applied and published by the worker it came from
+        if message["type"] == "events":
+            CHANNEL_EVENTS.labels("remote").inc(len(message["events"]))
+            events = [
+                await ChannelEvent.from_payload(self, payload)
+                for payload in message["events"]
             ]
-            await asyncio.gather(*tasks)
-            self.last_snapshot_hash = snapshot_hash
-            self.last_snapshot_sent_at = datetime.now(timezone.utc)
-
-    async def broadcast_snapshot_with_cooldown(self):
-        if (
-            datetime.now(timezone.utc)
-            > self.last_snapshot_sent_at + self.SNAPSHOT_COOLDOWN
-        ):
-            logger.debug("Handling snapshot immediately")
-            await self._broadcast_snapshot_if_changed()
+            await self.handle_events(events, publish=False)
+        elif message["type"] == "roster":
+            if message["op"] == "remove":
+                pids = [uuid.UUID(pid) for pid in message["ids"]]
+                await self.remove_participants(pids, publish=False)
+            else:
+                records = [
+                    ParticipantRecord.from_payload(payload)
+                    for payload in message["participants"]
+                ]
+                if message["op"] == "add":
+                    await self.add_participants(records, publish=False)
+                else:
+                    await self.update_participants(records, publish=False)
+        elif message["type"] == "sync":
+            # Another worker just loaded this meeting. Only workers that have
+            # seen events answer, the others know no more than it does.
+            if not self.needs_sync:
+                self.backend.publish(
+                    self.meeting.short_code,
+                    {"type": "state", "checkpoint": self.state.checkpoint()},
+                )
+        elif message["type"] == "state":
+            if self.needs_sync:
+                self.needs_sync = False
+                self.state.sync(message["checkpoint"])
+                await self.broadcast_changes_with_cooldown()
+
+    def send_snapshot(self, websocket: WebSocket):
+        self.connections[websocket].send_snapshot()
+
+    def _broadcast_changes(self):
+        delta = self.state.take_delta()
+        if delta is None:
+            logger.debug("No changes, skipping broadcast")
+            BROADCASTS.labels("unchanged").inc()
             return
-        # Delay sending the snapshot until cooldown expires, don't duplicate sends
-        if self.delayed_snapshot_task is None:
-            logger.debug("Enqueuing delayed snapshot")
+        BROADCASTS.labels("sent").inc()
+        with BROADCAST_DURATION.time():
+            # Encode once for each encoding in use, not once per connection
+            encoded = {}
+            for connection in self.connections.values():
+                encoding = connection.encoding
+                if encoding.name not in encoded:
+                    encoded[encoding.name] = encoding.encode_delta(self.state, delta)
+                    BROADCAST_BYTES.labels(encoding.name).observe(
+                        len(encoded[encoding.name])
+                    )
+                connection.send(encoded[encoding.name])
+        self.last_broadcast_at = datetime.now(timezone.utc)
+
+    async def broadcast_changes_with_cooldown(self):
+        cooldown = self.broadcast_cooldown()
+        if datetime.now(timezone.utc) > self.last_broadcast_at + cooldown:
+            logger.debug("Broadcasting changes immediately")
+            self._broadcast_changes()
+            return
+        # Delay the broadcast until cooldown expires, don't duplicate sends
+        if self.delayed_broadcast_task is None:
+            logger.debug("Enqueuing delayed broadcast")
+            BROADCASTS.labels("delayed").inc()
 
-            async def delayed_snapshot():
+            async def delayed_broadcast():
                 await asyncio.sleep(
                     (
-                        self.last_snapshot_sent_at
-                        + self.SNAPSHOT_COOLDOWN
-                        - datetime.now(timezone.utc)
+                        self.last_broadcast_at + cooldown - datetime.now(timezone.utc)
                     ).total_seconds()
                 )
-                logger.debug("Sending delayed snapshot")
-                await self._broadcast_snapshot_if_changed()
-                self.delayed_snapshot_task = None
+                logger.debug("Sending delayed broadcast")
+                self._broadcast_changes()
+                self.delayed_broadcast_task = None
 
-            self.delayed_snapshot_task = asyncio.create_task(delayed_snapshot())
+            self.delayed_broadcast_task = asyncio.create_task(delayed_broadcast())
         else:
-            logger.debug("Throttling sending snapshot")
+            logger.debug("Throttling broadcast")
+            BROADCASTS.labels("throttled").inc()
 
     def _maybe_start_simulated_task(self):
         any_simulated = any(
@@ -243,6 +839,7 @@ class MeetingChannel:
             self.simulated_event_task = None
 
     async def _simulated_participant_loop(self):
+        # Simulated cards are random noise, so they aren't shared between workers
         while True:
             try:
                 for pstate in self.state.participants.values():
@@ -257,8 +854,10 @@ class MeetingChannel:
                             event.participation.name,
                             event.state,
                         )
+                        CHANNEL_EVENTS.labels("simulated").inc()
                         self.state.apply_event(event)
-                await self.broadcast_snapshot_with_cooldown()
+                        self.count_events(1)
+                await self.broadcast_changes_with_cooldown()
                 await asyncio.sleep(self.SIMULATED_EVENT_INTERVAL.seconds)
             except asyncio.CancelledError:
                 logger.debug("Cancelled simulated events")
@@ -272,17 +871,116 @@ class MeetingChannel:
 
 
 class MeetingChannels:
-    def __init__(self):
-        self.channels = {}
-
-    def get(self, meeting: Meeting, session: Session):
-        if meeting.short_code not in self.channels:
-            participants = session.scalars(
-                select(Participation).where(Participation.meeting == meeting)
-            )
-            self.channels[meeting.short_code] = MeetingChannel(meeting, participants)
+    def __init__(self, backend=None, event_log=None):
+        # Least recently used first, so eviction can take from the front
+        self.channels = OrderedDict()
+        self.backend = backend or InProcessBackend()
+        self.event_log = event_log
+        self.loads = SingleFlight()
+        self.sweeper_task = None
+
+    async def start(self):
+        await self.backend.start(self.on_remote_message)
+        if self.event_log is not None:
+            await self.event_log.start()
+        self.sweeper_task = asyncio.create_task(self._sweep_loop())
+
+    async def stop(self):
+        if self.sweeper_task is not None:
+            self.sweeper_task.cancel()
+            self.sweeper_task = None
+        await self.backend.stop()
+        if self.event_log is not None:
+            for channel in self.channels.values():
+                channel.checkpoint()
+            await self.event_log.stop()
+
+    async def on_remote_message(self, short_code: str, message: dict):
+        # Meetings without a channel here have nobody connected to update
+        channel = self.channels.get(short_code)
+        if channel is None:
+            return
+        try:
+            await channel.handle_remote_message(message)
+        except Exception:
+            logger.exception("Error handling channel message for %s", short_code)
+
+    async def get(self, meeting: Meeting):
+        # Everyone reconnecting after a restart asks for the same meeting at
+        # once, so they share one load of it. It's loaded again in the unlikely
+        # case it was evicted before this caller got to run.
+        while meeting.short_code not in self.channels:
+            await self.loads.run(meeting.short_code, lambda: self._load(meeting))
+        self.channels.move_to_end(meeting.short_code)
         return self.channels[meeting.short_code]
 
+    async def _load(self, meeting: Meeting):
+        if meeting.short_code in self.channels:
+            return
+        async with AsyncSessionLocal() as session:
+            with DB_QUERY_DURATION.labels("roster").time():
+                participants = list(
+                    await session.scalars(
+                        select(Participation).where(Participation.meeting == meeting)
+                    )
+                )
+        channel = MeetingChannel(meeting, participants, self.backend, self.event_log)
+        if self.event_log is not None:
+            # Pick up where the meeting was before a restart or eviction
+            channel.state.restore(*await self.event_log.load(meeting.id))
+        self.channels[meeting.short_code] = channel
+        self._evict_over_capacity(keep=meeting.short_code)
+        # The event log can be a moment behind other workers, or off, so ask
+        # them for the meeting as they have it
+        self.backend.publish(meeting.short_code, {"type": "sync"})
+
     def remove(self, meeting: Meeting):
         if meeting.short_code in self.channels:
-            del self.channels[meeting.short_code]
+            channel = self.channels.pop(meeting.short_code)
+            channel.checkpoint()
+            channel.close()
+
+    def evict_idle(self, now: float | None = None):
+        now = time.monotonic() if now is None else now
+        for short_code, channel in list(self.channels.items()):
+            if (
+                channel.is_idle()
+                and now - channel.idle_since > settings.CHANNEL_IDLE_TTL
+            ):
+                self._evict(short_code, "idle")
+
+    def _evict_over_capacity(self, keep: str | None = None):
+        # Channels with connections are never evicted, so this can stay over the
+        # cap while every channel is in use. keep is the channel just loaded,
+        # which is idle until its first connection is added.
+        for short_code, channel in list(self.channels.items()):
+            if len(self.channels) <= settings.MAX_LIVE_CHANNELS:
+                return
+            if channel.is_idle() and short_code != keep:
+                self._evict(short_code, "capacity")
+
+    def _evict(self, short_code: str, reason: str):
+        logger.debug("Evicting channel %s (%s)", short_code, reason)
+        channel = self.channels.pop(short_code)
+        channel.checkpoint()
+        channel.close()
+        CHANNEL_EVICTIONS.labels(reason).inc()
+
+    async def reconcile_rosters(self, now: float | None = None):
+        now = time.monotonic() if now is None else now
+        for channel in list(self.channels.values()):
+            if now - channel.roster_loaded_at > settings.ROSTER_RECONCILE_INTERVAL:
+                # Every worker reconciles its own channels
+                async with AsyncSessionLocal() as session:
+                    await channel.refresh_participants(session)
+
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(settings.CHANNEL_SWEEP_INTERVAL)
+            try:
+                self.evict_idle()
+                for channel in self.channels.values():
+                    channel.checkpoint()
+                await self.reconcile_rosters()
+            except Exception:
+                logger.exception("Error sweeping idle channels")
@@ -1,4 +1,5 @@
 from pathlib import Path
+from typing import Literal
 
 from pydantic import PostgresDsn
 from pydantic_settings import BaseSettings, SettingsConfigDict
@@ -6,6 +7,53 @@ from pydantic_settings import BaseSettings, SettingsConfigDict
 
 class Settings(BaseSettings):
     POSTGRES_DSN: PostgresDsn
+    # Use "postgres" when running more than one worker process
+    CHANNEL_BACKEND: Literal["memory", "postgres"] = "memory"
+    # Connection pool sizing, applied to each engine separately
+    DB_POOL_SIZE: int = 5
+    DB_MAX_OVERFLOW: int = 10
+    DB_POOL_TIMEOUT: float = 30
+    # Messages queued for a websocket before falling back to a snapshot, and how
+    # long a single send may stall before the client is disconnected
+    WS_SEND_QUEUE_SIZE: int = 32
+    WS_SEND_TIMEOUT: float = 10
+    # Frames read ahead from a websocket while its last batch is being applied
+    WS_RECEIVE_QUEUE_SIZE: int = 64
+    # Handshakes handled at once by each worker. Past that, clients are told to
+    # come back after about WS_RETRY_AFTER seconds.
+    WS_MAX_HANDSHAKES: int = 100
+    WS_RETRY_AFTER: float = 5
+    # Each channel waits at least BROADCAST_COOLDOWN_MIN seconds between
+    # broadcasts. Once its event rate times its connections would send more than
+    # BROADCAST_MESSAGE_BUDGET messages a second, broadcasts are spaced out to
+    # stay within it, up to BROADCAST_COOLDOWN_MAX seconds apart.
+    BROADCAST_COOLDOWN_MIN: float = 0.05
+    BROADCAST_COOLDOWN_MAX: float = 2
+    BROADCAST_MESSAGE_BUDGET: float = 5000
+    # Channels nobody is connected to are dropped after CHANNEL_IDLE_TTL
+    # seconds, or sooner once there are more than MAX_LIVE_CHANNELS of them
+    CHANNEL_IDLE_TTL: float = 600
+    CHANNEL_SWEEP_INTERVAL: float = 60
+    MAX_LIVE_CHANNELS: int = 1000
+    # Rosters are kept up to date one change at a time, and reloaded in full
+    # every ROSTER_RECONCILE_INTERVAL seconds in case a change was missed
+    ROSTER_RECONCILE_INTERVAL: float = 600
+    # Authenticated users are cached per worker, so changes made by another
+    # worker can take up to USER_CACHE_TTL seconds to show up
+    USER_CACHE_SIZE: int = 10000
+    USER_CACHE_TTL: float = 60
+    MEETING_CACHE_SIZE: int = 10000
+    MEETING_CACHE_TTL: float = 3600
+    # Card events are written behind to the database in batches, at least every
+    # EVENT_LOG_FLUSH_INTERVAL seconds. Past EVENT_LOG_MAX_BUFFER unwritten rows
+    # new ones are dropped.
+    EVENT_LOG_ENABLED: bool = True
+    EVENT_LOG_FLUSH_INTERVAL: float = 1
+    EVENT_LOG_BATCH_SIZE: int = 500
+    EVENT_LOG_MAX_BUFFER: int = 100000
+    # Lets hosts attach the load generator to their meetings, for capacity
+    # testing only
+    LOADGEN_ENABLED: bool = False
 
     model_config = SettingsConfigDict(
         env_prefix="UCA_MEETINGS_",
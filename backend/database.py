@@ -1,13 +1,80 @@
+import time
 from typing import Annotated
 
 from fastapi import Depends
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, exc, make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
 
 from config import settings
+from metrics import (
+    DB_POOL_CHECKED_OUT,
+    DB_POOL_CHECKOUTS,
+    DB_POOL_TIMEOUTS,
+    DB_POOL_WAIT,
+)
 
-engine = create_engine(str(settings.POSTGRES_DSN))
+
+class TimedPoolMixin:
+    # Label for the pool metrics, set on the subclasses below
+    metrics_label = None
+
+    def _do_get(self):
+        started_at = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            DB_POOL_TIMEOUTS.labels(self.metrics_label).inc()
+            raise
+        finally:
+            DB_POOL_WAIT.labels(self.metrics_label).observe(
+                time.perf_counter() - started_at
+            )
+
+
+class TimedQueuePool(TimedPoolMixin, QueuePool):
+    metrics_label = "sync"
+
+
+class TimedAsyncPool(TimedPoolMixin, AsyncAdaptedQueuePool):
+    metrics_label = "async"
+
+
+def pool_options():
+    return {
+        "pool_size": settings.DB_POOL_SIZE,
+        "max_overflow": settings.DB_MAX_OVERFLOW,
+        "pool_timeout": settings.DB_POOL_TIMEOUT,
+    }
+
+
+def instrument_pool(engine, label):
+    checked_out = DB_POOL_CHECKED_OUT.labels(label)
+    checked_out.set_function(engine.pool.checkedout)
+
+    @event.listens_for(engine, "checkout")
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        DB_POOL_CHECKOUTS.labels(label).inc()
+
+
+engine = create_engine(
+    str(settings.POSTGRES_DSN), poolclass=TimedQueuePool, **pool_options()
+)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+instrument_pool(engine, TimedQueuePool.metrics_label)
+
+async_engine = create_async_engine(
+    make_url(str(settings.POSTGRES_DSN)).set(drivername="postgresql+asyncpg"),
+    poolclass=TimedAsyncPool,
+    **pool_options(),
+)
+# Objects are used after commit to build responses, and lazy loading them again
+# isn't possible with async sessions
+AsyncSessionLocal = async_sessionmaker(
+    bind=async_engine, autoflush=False, expire_on_commit=False
+)
+instrument_pool(async_engine.sync_engine, TimedAsyncPool.metrics_label)
 
 
 def get_session():
@@ -18,4 +85,10 @@ def get_session():
         session.close()
 
 
+async def get_async_session():
+    async with AsyncSessionLocal() as session:
+        yield session
+
+
 DbSession = Annotated[Session, Depends(get_session)]
+AsyncDbSession = Annotated[AsyncSession, Depends(get_async_session)]
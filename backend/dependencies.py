@@ -3,17 +3,28 @@ from typing import Annotated
 
 from fastapi import Depends, HTTPException
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
-from sqlalchemy import select
+from sqlalchemy import event, select
 
-from database import DbSession
+from cache import TTLCache
+from config import settings
+from database import AsyncDbSession
+from metrics import DB_QUERY_DURATION
 from models import User
 
 security = HTTPBearer()
+# Detached User rows keyed by id, which is also the bearer token
+user_cache = TTLCache("user", settings.USER_CACHE_SIZE, settings.USER_CACHE_TTL)
+
+
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def invalidate_cached_user(mapper, connection, target):
+    user_cache.invalidate(target.id)
 
 
 async def get_current_user(
     credentials: Annotated[HTTPAuthorizationCredentials, Depends(security)],
-    session: DbSession,
+    session: AsyncDbSession,
 ):
     try:
         user_uuid = uuid.UUID(credentials.credentials)
@@ -21,11 +32,18 @@ async def get_current_user(
         raise HTTPException(
             status_code=401, detail="Invalid authorization header"
         ) from e
-    stmt = select(User).where(User.id == user_uuid)
-    results = session.scalars(stmt).all()
-    if not len(results) == 1:
-        raise HTTPException(status_code=401, detail="Unknown user")
-    return results[0]
+    user = user_cache.get(user_uuid)
+    if user is None:
+        stmt = select(User).where(User.id == user_uuid)
+        with DB_QUERY_DURATION.labels("user").time():
+            results = (await session.scalars(stmt)).all()
+        if not len(results) == 1:
+            raise HTTPException(status_code=401, detail="Unknown user")
+        user = results[0]
+        session.expunge(user)
+        user_cache.set(user_uuid, user)
+    # Each request gets its own copy, so changes to it never touch the cache
+    return await session.merge(user, load=False)
 
 
 CurrentUser = Annotated[User, Depends(get_current_user)]
@@ -0,0 +1,98 @@
+import json
+
+import msgpack
+
+# Wire codes for the compact encoding. Clients decode these by position, so
+# only ever append to them.
+CARD_STATES = [
+    "none",
+    "warm",
+    "cool",
+    "question",
+    "question_warm",
+    "question_cool",
+    "move_on",
+]
+ROLES = ["host", "member"]
+OPS = ["card", "question_push", "question_pop", "add", "remove", "rename", "role"]
+SNAPSHOT, DELTA = 0, 1
+
+CARD_STATE_CODES = {state: code for code, state in enumerate(CARD_STATES)}
+ROLE_CODES = {role: code for code, role in enumerate(ROLES)}
+OP_CODES = {op: code for code, op in enumerate(OPS)}
+
+
+class JsonEncoding:
+    name = "json"
+    subprotocol = "uca.json.v1"
+
+    def encode_snapshot(self, state, snapshot: dict):
+        return json.dumps(snapshot)
+
+    def encode_delta(self, state, delta: dict):
+        return json.dumps(delta)
+
+
+class MsgpackEncoding:
+    # Positional records, with participants referred to by their index in the
+    # meeting instead of a 36 character UUID:
+    #   snapshot: [0, version, [[index, id, name, role, card], ...], [index, ...]]
+    #   delta:    [1, version, [[op, index, *values], ...]]
+    name = "msgpack"
+    subprotocol = "uca.msgpack.v1"
+
+    def encode_snapshot(self, state, snapshot: dict):
+        return msgpack.packb(
+            [
+                SNAPSHOT,
+                snapshot["version"],
+                [self._participant(state, p) for p in snapshot["participants"]],
+                [state.indexes[pid] for pid in snapshot["questions"]],
+            ]
+        )
+
+    def encode_delta(self, state, delta: dict):
+        return msgpack.packb(
+            [
+                DELTA,
+                delta["version"],
+                [self._change(state, change) for change in delta["changes"]],
+            ]
+        )
+
+    def _participant(self, state, participant: dict):
+        return [
+            state.indexes[participant["id"]],
+            participant["id"],
+            participant["name"],
+            ROLE_CODES[participant["role"]],
+            CARD_STATE_CODES[participant["card_state"]],
+        ]
+
+    def _change(self, state, change: dict):
+        op = change["op"]
+        if op == "add":
+            return [OP_CODES[op], *self._participant(state, change["participant"])]
+        record = [OP_CODES[op], state.indexes[change["id"]]]
+        if op == "card":
+            record.append(CARD_STATE_CODES[change["card_state"]])
+        elif op == "rename":
+            record.append(change["name"])
+        elif op == "role":
+            record.append(ROLE_CODES[change["role"]])
+        return record
+
+
+JSON = JsonEncoding()
+MSGPACK = MsgpackEncoding()
+# In order of preference when a client offers more than one
+ENCODINGS = [MSGPACK, JSON]
+
+
+def negotiate(offered: list[str]):
+    # Returns the chosen encoding and the subprotocol to accept, which is None
+    # for clients that didn't ask for one
+    for encoding in ENCODINGS:
+        if encoding.subprotocol in offered:
+            return encoding, encoding.subprotocol
+    return JSON, None
@@ -0,0 +1,33 @@
+import hashlib
+
+from fastapi import Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+
+def make_etag(*parts) -> str:
+    # Strong ETag over row ids and versions, so it changes whenever a row the
+    # response is built from is written
+    digest = hashlib.blake2b(
+        "|".join(str(part) for part in parts).encode(), digest_size=12
+    )
+    return f'"{digest.hexdigest()}"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if header is None:
+        return False
+    if header.strip() == "*":
+        return True
+    return etag in (tag.strip().removeprefix("W/") for tag in header.split(","))
+
+
+def conditional_response(request: Request, etag: str, build) -> Response:
+    # build() is only called, and its result serialised, when the client's copy
+    # is out of date. Responses depend on who's asking, so they're only cached
+    # privately, and revalidated before each use.
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(jsonable_encoder(build()), headers=headers)
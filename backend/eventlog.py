@@ -0,0 +1,150 @@
+import asyncio
+import itertools
+import logging
+import uuid
+
+from sqlalchemy import insert, select
+
+from config import settings
+from database import AsyncSessionLocal
+from metrics import DB_QUERY_DURATION, EVENT_LOG_DROPPED, EVENT_LOG_WRITTEN
+from models import MeetingCheckpoint, MeetingEvent
+
+logger = logging.getLogger("uvicorn.error")
+
+
+# Write-behind log of meeting events and checkpoints. Channels only append to
+# an in-memory buffer, and a background task writes it out in batches, so
+# persisting an event never holds up handling it.
+class EventLog:
+    def __init__(self):
+        # (kind, meeting id, payload) in the order they happened
+        self.buffer = []
+        self.wakeup = asyncio.Event()
+        self.flush_lock = asyncio.Lock()
+        self.flush_task = None
+        self.stopping = False
+        # Last event id written or restored for each meeting, which the next
+        # checkpoint of that meeting covers
+        self.last_event_ids = {}
+
+    async def start(self):
+        # Made afresh, as an event is tied to the loop that first waits on it
+        self.wakeup = asyncio.Event()
+        self.stopping = False
+        self.flush_task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        if self.flush_task is not None:
+            # The loop is left to finish rather than cancelled, as a batch it's
+            # writing is no longer in the buffer and would be lost
+            self.stopping = True
+            self.wakeup.set()
+            await self.flush_task
+            self.flush_task = None
+        await self.flush()
+
+    def append(self, meeting_id: uuid.UUID, payloads: list[dict]):
+        self._buffer("event", meeting_id, payloads)
+
+    def checkpoint(self, meeting_id: uuid.UUID, state: dict):
+        self._buffer("checkpoint", meeting_id, [state])
+
+    def _buffer(self, kind: str, meeting_id: uuid.UUID, payloads: list[dict]):
+        if len(self.buffer) >= settings.EVENT_LOG_MAX_BUFFER:
+            # The database has fallen too far behind, losing history is better
+            # than running out of memory
+            EVENT_LOG_DROPPED.labels(kind).inc(len(payloads))
+            return
+        self.buffer.extend((kind, meeting_id, payload) for payload in payloads)
+        if len(self.buffer) >= settings.EVENT_LOG_BATCH_SIZE:
+            self.wakeup.set()
+
+    async def flush(self):
+        # One flush at a time, so batches reach the database in order
+        async with self.flush_lock:
+            batch, self.buffer = self.buffer, []
+            if not batch:
+                return
+            try:
+                with DB_QUERY_DURATION.labels("event_log").time():
+                    await self._write(batch)
+            except Exception:
+                logger.exception("Failed to write %d event log rows", len(batch))
+                for kind, rows in itertools.groupby(batch, key=lambda row: row[0]):
+                    EVENT_LOG_DROPPED.labels(kind).inc(len(list(rows)))
+
+    async def _write(self, batch: list):
+        async with AsyncSessionLocal() as session:
+            for kind, rows in itertools.groupby(batch, key=lambda row: row[0]):
+                rows = [
+                    {"meeting_id": meeting_id, "payload": payload}
+                    for _, meeting_id, payload in rows
+                ]
+                if kind == "event":
+                    result = await session.execute(
+                        insert(MeetingEvent).returning(
+                            MeetingEvent.id, MeetingEvent.meeting_id
+                        ),
+                        rows,
+                    )
+                    for event_id, meeting_id in result:
+                        self.last_event_ids[meeting_id] = max(
+                            event_id, self.last_event_ids.get(meeting_id, 0)
+                        )
+                else:
+                    await session.execute(
+                        insert(MeetingCheckpoint),
+                        [
+                            {
+                                "meeting_id": row["meeting_id"],
+                                "last_event_id": self.last_event_ids.get(
+                                    row["meeting_id"]
+                                ),
+                                "state": row["payload"],
+                            }
+                            for row in rows
+                        ],
+                    )
+                EVENT_LOG_WRITTEN.labels(kind).inc(len(rows))
+            await session.commit()
+
+    async def load(self, meeting_id: uuid.UUID):
+        """Returns the latest checkpoint of a meeting and the events after it."""
+        # Anything still buffered for it has to be in the database first
+        await self.flush()
+        async with AsyncSessionLocal() as session:
+            with DB_QUERY_DURATION.labels("event_log").time():
+                checkpoint = (
+                    await session.scalars(
+                        select(MeetingCheckpoint)
+                        .where(MeetingCheckpoint.meeting_id == meeting_id)
+                        .order_by(MeetingCheckpoint.id.desc())
+                        .limit(1)
+                    )
+                ).first()
+                after = checkpoint.last_event_id if checkpoint else None
+                stmt = select(MeetingEvent.id, MeetingEvent.payload).where(
+                    MeetingEvent.meeting_id == meeting_id
+                )
+                if after is not None:
+                    stmt = stmt.where(MeetingEvent.id > after)
+                events = (await session.execute(stmt.order_by(MeetingEvent.id))).all()
+        if events:
+            self.last_event_ids[meeting_id] = events[-1].id
+        elif after is not None:
+            self.last_event_ids[meeting_id] = after
+        return (
+            checkpoint.state if checkpoint else None,
+            [event.payload for event in events],
+        )
+
+    async def _flush_loop(self):
+        while not self.stopping:
+            try:
+                async with asyncio.timeout(settings.EVENT_LOG_FLUSH_INTERVAL):
+                    await self.wakeup.wait()
+            except TimeoutError:
+                pass
+            self.wakeup.clear()
+            await self.flush()
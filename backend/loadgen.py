@@ -0,0 +1,255 @@
+"""Load generator for meeting channels.
+
+Adds in-memory participants to a channel and flips their cards at a
+configurable rate, then reports what that cost. It can be attached to a live
+meeting through the API (see UCA_MEETINGS_LOADGEN_ENABLED), or run standalone
+against a channel with no database behind it:
+
+    python loadgen.py --participants 5000 --connections 200 --rate 500 --burst 20
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+from dataclasses import asdict, dataclass
+
+from channel import CardChangeEvent, CardState, MeetingChannel, ParticipantRecord
+from metrics import CHANNEL_EVENTS
+from models import Meeting, Role
+
+# Roughly what a real meeting looks like: mostly warm and cool, some questions
+DEFAULT_CARDS = {
+    CardState.NONE: 3,
+    CardState.WARM: 3,
+    CardState.COOL: 2,
+    CardState.QUESTION: 1,
+    CardState.QUESTION_WARM: 0.5,
+    CardState.QUESTION_COOL: 0.5,
+    CardState.MOVE_ON: 1,
+}
+
+
+@dataclass
+class LoadReport:
+    participants: int
+    connections: int
+    duration: float
+    events: int
+    event_rate: float
+    broadcasts: int
+    broadcast_rate: float
+    fanout_latency_p50_ms: float | None
+    fanout_latency_p95_ms: float | None
+    fanout_latency_max_ms: float | None
+    cpu_per_event_us: float | None
+
+
+class ProbeWebSocket:
+    # Stands in for a client at the end of the fan-out. It's connected after
+    # every other client, so its writer is woken last and sees the time from an
+    # event being applied to its delta going out to the whole meeting.
+    def __init__(self, generator: "LoadGenerator"):
+        self.generator = generator
+        self.scope = {"subprotocols": []}
+
+    async def accept(self, subprotocol=None):
+        pass
+
+    async def send_text(self, text):
+        message = json.loads(text)
+        if message["type"] == "delta":
+            self.generator.delivered(message["version"])
+
+    async def close(self, code=1000):
+        pass
+
+
+class LoadGenerator:
+    def __init__(
+        self,
+        channel: MeetingChannel,
+        participants: int,
+        rate: float,
+        burst: int = 1,
+        cards: dict[CardState, float] | None = None,
+    ):
+        self.channel = channel
+        self.rate = rate
+        self.burst = burst
+        cards = cards or DEFAULT_CARDS
+        self.card_states = list(cards)
+        self.card_weights = list(cards.values())
+        # No rows behind these, so they only exist in this channel. They aren't
+        # marked simulated, that would start the simulated card loop.
+        self.participants = [
+            ParticipantRecord(
+                id=uuid.uuid4(), name=f"Load {i:05d}", role=Role.MEMBER, simulated=False
+            )
+            for i in range(participants)
+        ]
+        self.probe = ProbeWebSocket(self)
+        self.task = None
+        self.events = 0
+        self.broadcasts = 0
+        # Version each pending delta will go out as, to when its first event was
+        # applied
+        self.pending = {}
+        self.latencies = []
+
+    async def start(self):
+        self.started_at = time.perf_counter()
+        self.cpu_started_at = time.process_time()
+        self.channel.load_generator = self
+        roster = [p.participation for p in self.channel.state.participants.values()]
+        self.channel.state.set_participants(roster + self.participants)
+        await self.channel.add_connection(self.probe)
+        await self.channel.broadcast_changes_with_cooldown()
+        self.task = asyncio.create_task(self._run())
+
+    def cancel(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def stop(self):
+        report = self.report()
+        self.cancel()
+        self.channel.load_generator = None
+        self.channel.remove_connection(self.probe)
+        load_pids = {p.id for p in self.participants}
+        self.channel.state.set_participants(
+            pstate.participation
+            for pid, pstate in self.channel.state.participants.items()
+            if pid not in load_pids
+        )
+        await self.channel.broadcast_changes_with_cooldown()
+        return report
+
+    def delivered(self, version: int):
+        now = time.perf_counter()
+        self.broadcasts += 1
+        # Earlier versions only show up here if their delta was replaced by a
+        # snapshot, so they're dropped rather than measured
+        for pending_version in [v for v in self.pending if v <= version]:
+            applied_at = self.pending.pop(pending_version)
+            if pending_version == version:
+                self.latencies.append(now - applied_at)
+
+    def report(self) -> LoadReport:
+        duration = time.perf_counter() - self.started_at
+        cpu = time.process_time() - self.cpu_started_at
+        latencies = sorted(self.latencies)
+
+        def percentile(p):
+            if not latencies:
+                return None
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+
+        return LoadReport(
+            participants=len(self.participants),
+            connections=len(self.channel.connections) - 1,
+            duration=duration,
+            events=self.events,
+            event_rate=self.events / duration,
+            broadcasts=self.broadcasts,
+            broadcast_rate=self.broadcasts / duration,
+            fanout_latency_p50_ms=percentile(0.5),
+            fanout_latency_p95_ms=percentile(0.95),
+            fanout_latency_max_ms=latencies[-1] * 1000 if latencies else None,
+            cpu_per_event_us=cpu / self.events * 1e6 if self.events else None,
+        )
+
+    async def _run(self):
+        while True:
+            # Bursts arrive as a Poisson process, so the average event rate
+            # stays the same whatever the burst size
+            await asyncio.sleep(random.expovariate(self.rate / self.burst))
+            for _ in range(self.burst):
+                await self._emit()
+
+    async def _emit(self):
+        event = CardChangeEvent(
+            participation=random.choice(self.participants),
+            state=random.choices(self.card_states, self.card_weights)[0],
+        )
+        state = self.channel.state
+        version = state.version
+        applied_at = time.perf_counter()
+        CHANNEL_EVENTS.labels("loadgen").inc()
+        # Load events are local noise like simulated ones, so not published
+        await self.channel.handle_event(event, publish=False)
+        self.events += 1
+        if state.version > version or state.changes:
+            self.pending.setdefault(version + 1, applied_at)
+
+
+class SinkWebSocket:
+    # A client that accepts everything instantly, for standalone runs
+    def __init__(self, subprotocols):
+        self.scope = {"subprotocols": subprotocols}
+        self.bytes_received = 0
+
+    async def accept(self, subprotocol=None):
+        pass
+
+    async def send_text(self, text):
+        self.bytes_received += len(text)
+
+    async def send_bytes(self, data):
+        self.bytes_received += len(data)
+
+    async def close(self, code=1000):
+        pass
+
+
+def parse_cards(value: str):
+    cards = {}
+    for item in value.split(","):
+        state, weight = item.split("=")
+        cards[CardState(state)] = float(weight)
+    return cards
+
+
+async def run_standalone(args):
+    meeting = Meeting(
+        id=uuid.uuid4(), short_code="loadgen", name="Load test", anonymous=False
+    )
+    channel = MeetingChannel(meeting, [])
+    subprotocols = [] if args.encoding == "json" else ["uca.msgpack.v1"]
+    for _ in range(args.connections):
+        await channel.add_connection(SinkWebSocket(subprotocols))
+    generator = LoadGenerator(
+        channel, args.participants, args.rate, args.burst, args.cards
+    )
+    await generator.start()
+    await asyncio.sleep(args.duration)
+    report = await generator.stop()
+    channel.close()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--participants", type=int, default=1000)
+    parser.add_argument("--connections", type=int, default=100)
+    parser.add_argument("--rate", type=float, default=100, help="events per second")
+    parser.add_argument("--burst", type=int, default=1, help="events per burst")
+    parser.add_argument(
+        "--cards",
+        type=parse_cards,
+        default=None,
+        help="card weights, eg warm=3,cool=2,question=1",
+    )
+    parser.add_argument("--encoding", choices=["json", "msgpack"], default="json")
+    parser.add_argument("--duration", type=float, default=10, help="seconds")
+    args = parser.parse_args()
+    report = asyncio.run(run_standalone(args))
+    for key, value in asdict(report).items():
+        print(f"{key}: {value:.2f}" if isinstance(value, float) else f"{key}: {value}")
+
+
+if __name__ == "__main__":
+    main()
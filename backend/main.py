@@ -1,28 +1,43 @@
+from contextlib import asynccontextmanager
 from pathlib import Path
 
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import FileResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi import FastAPI, HTTPException, Request
 
-from routers import meetings, users
+from routers import meetings, metrics, users
+from static_files import IndexPage, PrecompressedStaticFiles
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await meetings.meeting_channels.start()
+    yield
+    await meetings.meeting_channels.stop()
+
+
+app = FastAPI(lifespan=lifespan)
 
 app.include_router(users.router)
 app.include_router(meetings.router)
+app.include_router(metrics.router)
 
 
 BACKEND_DIR = Path(__file__).resolve().parent
 STATIC_DIR = BACKEND_DIR / "static"
 
 
-# Fallback to static files
-app.mount("/static", StaticFiles(directory=str(STATIC_DIR)), name="static")
+# Fallback to static files. The frontend build is put in static/ by deploy.sh, or
+# linked there in development, so it may not be there yet.
+app.mount(
+    "/static",
+    PrecompressedStaticFiles(directory=str(STATIC_DIR), check_dir=False),
+    name="static",
+)
+index_page = IndexPage(STATIC_DIR / "index.html")
 
 
 # And then really fall back to index.html
 @app.get("{full_path:path}")
-def default_index(full_path: str):
+def default_index(full_path: str, request: Request):
     if full_path.startswith("/api/"):
         raise HTTPException(status_code=404, detail="Not found")
-    return FileResponse(STATIC_DIR / "index.html")
+    return index_page.response(request)
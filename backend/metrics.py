@@ -0,0 +1,91 @@
+from prometheus_client import Counter, Gauge, Histogram
+
+DB_POOL_CHECKOUTS = Counter(
+    "uca_db_pool_checkouts_total",
+    "Connections checked out of the database pool",
+    ["engine"],
+)
+DB_POOL_TIMEOUTS = Counter(
+    "uca_db_pool_timeouts_total",
+    "Checkouts that gave up waiting for a pooled connection",
+    ["engine"],
+)
+DB_POOL_WAIT = Histogram(
+    "uca_db_pool_wait_seconds",
+    "Time spent waiting to check a connection out of the pool",
+    ["engine"],
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30),
+)
+DB_POOL_CHECKED_OUT = Gauge(
+    "uca_db_pool_checked_out",
+    "Connections currently checked out of the pool",
+    ["engine"],
+)
+
+CHANNEL_EVICTIONS = Counter(
+    "uca_channel_evictions_total",
+    "Meeting channels dropped from memory",
+    ["reason"],
+)
+
+CACHE_HITS = Counter("uca_cache_hits_total", "Lookups served from a cache", ["cache"])
+CACHE_MISSES = Counter(
+    "uca_cache_misses_total", "Lookups that missed a cache", ["cache"]
+)
+
+BROADCAST_BYTES = Histogram(
+    "uca_broadcast_message_bytes",
+    "Encoded size of each broadcast delta, before websocket compression",
+    ["encoding"],
+    buckets=(64, 256, 1024, 4096, 16384, 65536, 262144),
+)
+
+LIVE_CHANNELS = Gauge("uca_live_channels", "Meeting channels held in memory")
+LIVE_WEBSOCKETS = Gauge("uca_live_websockets", "Websockets connected to a channel")
+WEBSOCKET_REJECTIONS = Counter(
+    "uca_websocket_rejections_total",
+    "Websockets turned away because too many handshakes were in progress",
+)
+CHANNEL_EVENTS = Counter(
+    "uca_channel_events_total",
+    "Card events applied to a meeting channel",
+    ["source"],
+)
+# sent, unchanged (nothing to send), delayed (until the cooldown ends) or
+# throttled (folded into a broadcast that's already delayed)
+BROADCASTS = Counter(
+    "uca_broadcasts_total",
+    "Requests to broadcast a channel's changes, by outcome",
+    ["outcome"],
+)
+BROADCAST_COOLDOWN = Gauge(
+    "uca_broadcast_cooldown_seconds",
+    "Current minimum time between broadcasts for each live channel",
+    ["meeting"],
+)
+BROADCAST_DURATION = Histogram(
+    "uca_broadcast_duration_seconds",
+    "Time to encode a delta and queue it for every connection",
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1),
+)
+BYTES_SENT = Counter(
+    "uca_websocket_sent_bytes_total",
+    "Bytes written to websockets, before websocket compression",
+    ["encoding"],
+)
+EVENT_LOG_WRITTEN = Counter(
+    "uca_event_log_written_total",
+    "Event log rows written to the database",
+    ["kind"],
+)
+EVENT_LOG_DROPPED = Counter(
+    "uca_event_log_dropped_total",
+    "Event log rows dropped because the database couldn't keep up",
+    ["kind"],
+)
+DB_QUERY_DURATION = Histogram(
+    "uca_db_query_duration_seconds",
+    "Time spent on the hot database lookups",
+    ["query"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1, 5),
+)
@@ -6,6 +6,7 @@ from enum import Enum
 from typing import List, Optional
 
 import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 
 
@@ -13,13 +14,24 @@ class Base(DeclarativeBase):
     pass
 
 
+def row_version():
+    # Postgres changes a row's xmin whenever it's written, which makes it a free
+    # version marker for ETags. It can't be written to, so it's left out of
+    # INSERTs as a server default and read back from them.
+    return mapped_column(
+        "xmin", sa.BigInteger, system=True, server_default=sa.FetchedValue()
+    )
+
+
 class Meeting(Base):
     __tablename__ = "meeting"
 
     id: Mapped[uuid.UUID] = mapped_column(
         primary_key=True, server_default=sa.text("gen_random_uuid()")
     )
-    short_code: Mapped[sa.Text] = mapped_column(sa.Text, nullable=False)
+    short_code: Mapped[sa.Text] = mapped_column(
+        sa.Text, nullable=False, unique=True, index=True
+    )
     name: Mapped[sa.Text] = mapped_column(sa.Text, nullable=False)
     anonymous: Mapped[bool] = mapped_column(
         nullable=False, server_default=sa.text("false")
@@ -27,6 +39,7 @@ class Meeting(Base):
     created_at: Mapped[Optional[datetime.datetime]] = mapped_column(
         server_default=sa.func.now(), nullable=False
     )
+    version: Mapped[int] = row_version()
     participants: Mapped[List["User"]] = relationship(
         "Participation", back_populates="meeting", cascade="all, delete-orphan"
     )
@@ -42,6 +55,7 @@ class User(Base):
     created_at: Mapped[Optional[datetime.datetime]] = mapped_column(
         server_default=sa.func.now(), nullable=False
     )
+    version: Mapped[int] = row_version()
     meetings: Mapped[List["Meeting"]] = relationship(
         "Participation", back_populates="user", cascade="all, delete-orphan"
     )
@@ -73,6 +87,7 @@ class Participation(Base):
     simulated: Mapped[bool] = mapped_column(
         nullable=False, server_default=sa.text("false")
     )
+    version: Mapped[int] = row_version()
 
     meeting = relationship("Meeting", back_populates="participants")
     user = relationship("User", back_populates="meetings")
@@ -81,5 +96,42 @@ class Participation(Base):
     )
 
 
+# Every card event applied in a meeting, written behind in batches by
+# eventlog.EventLog
+class MeetingEvent(Base):
+    __tablename__ = "meeting_event"
+
+    id: Mapped[int] = mapped_column(sa.BigInteger, sa.Identity(), primary_key=True)
+    meeting_id: Mapped[uuid.UUID] = mapped_column(
+        sa.ForeignKey("meeting.id", ondelete="CASCADE"), nullable=False
+    )
+    payload: Mapped[dict] = mapped_column(JSONB, nullable=False)
+    created_at: Mapped[Optional[datetime.datetime]] = mapped_column(
+        server_default=sa.func.now(), nullable=False
+    )
+
+    __table_args__ = (sa.Index("ix_meeting_event_meeting_id_id", "meeting_id", "id"),)
+
+
+# Cards and question queue of a meeting as of last_event_id, so restoring it
+# only needs to replay the events after that
+class MeetingCheckpoint(Base):
+    __tablename__ = "meeting_checkpoint"
+
+    id: Mapped[int] = mapped_column(sa.BigInteger, sa.Identity(), primary_key=True)
+    meeting_id: Mapped[uuid.UUID] = mapped_column(
+        sa.ForeignKey("meeting.id", ondelete="CASCADE"), nullable=False
+    )
+    last_event_id: Mapped[Optional[int]] = mapped_column(sa.BigInteger)
+    state: Mapped[dict] = mapped_column(JSONB, nullable=False)
+    created_at: Mapped[Optional[datetime.datetime]] = mapped_column(
+        server_default=sa.func.now(), nullable=False
+    )
+
+    __table_args__ = (
+        sa.Index("ix_meeting_checkpoint_meeting_id_id", "meeting_id", "id"),
+    )
+
+
 def gen_short_code():
     return "".join(random.choices(string.ascii_letters, k=6))
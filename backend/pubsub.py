@@ -0,0 +1,209 @@
+import asyncio
+import base64
+import json
+import logging
+import time
+import uuid
+
+import psycopg2
+import psycopg2.extensions
+
+logger = logging.getLogger("uvicorn.error")
+
+
+# Channel backend for a single process, where there is nobody else to tell
+class InProcessBackend:
+    async def start(self, on_message):
+        self.on_message = on_message
+
+    async def stop(self):
+        pass
+
+    def publish(self, short_code: str, message: dict):
+        pass
+
+
+# Shares channel messages between worker processes with LISTEN/NOTIFY. Every
+# worker listens on the same Postgres channel, and messages carry the id of the
+# publishing worker so workers can skip their own.
+class PostgresBackend:
+    CHANNEL = "uca_meetings"
+    RECONNECT_DELAY = 5
+    # NOTIFY payloads must be under 8000 bytes. Longer messages are sent in
+    # parts of this many bytes, base64 encoded so they need no escaping.
+    PART_SIZE = 5000
+    # Parts of a message still missing after this many seconds were lost, say
+    # while the listener reconnected
+    PART_TIMEOUT = 60
+
+    def __init__(self, dsn: str):
+        self.dsn = dsn
+        self.origin = str(uuid.uuid4())
+        self.listen_conn = None
+        self.publish_conn = None
+        self.outbox = asyncio.Queue()
+        self.publish_task = None
+        # (short code, message) received from other workers, handled one at a
+        # time in the order they arrived
+        self.inbox = asyncio.Queue()
+        self.receive_task = None
+        self.reconnect_task = None
+        # (origin, message id) to when the first part arrived and the parts so far
+        self.partial = {}
+
+    async def start(self, on_message):
+        self.on_message = on_message
+        self._listen()
+        self.publish_task = asyncio.create_task(self._publish_loop())
+        self.receive_task = asyncio.create_task(self._receive_loop())
+
+    async def stop(self):
+        for task in (self.publish_task, self.receive_task, self.reconnect_task):
+            if task is not None:
+                task.cancel()
+        self._close_listener()
+        if self.publish_conn is not None:
+            self.publish_conn.close()
+            self.publish_conn = None
+
+    def publish(self, short_code: str, message: dict):
+        # Never wait on the database here, the publish loop sends it
+        payload = json.dumps(
+            {"origin": self.origin, "short_code": short_code, "message": message}
+        )
+        if len(payload) < self.PART_SIZE:
+            self.outbox.put_nowait(payload)
+            return
+        # Only ascii, json.dumps escapes everything else
+        data = payload.encode()
+        message_id = str(uuid.uuid4())
+        parts = range(0, len(data), self.PART_SIZE)
+        for index, start in enumerate(parts):
+            self.outbox.put_nowait(
+                json.dumps(
+                    {
+                        "origin": self.origin,
+                        "id": message_id,
+                        "part": index,
+                        "parts": len(parts),
+                        "data": base64.b64encode(
+                            data[start : start + self.PART_SIZE]
+                        ).decode(),
+                    }
+                )
+            )
+
+    def _listen(self):
+        self.listen_conn = psycopg2.connect(self.dsn)
+        self.listen_conn.set_isolation_level(
+            psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT
+        )
+        with self.listen_conn.cursor() as cursor:
+            cursor.execute(f"LISTEN {self.CHANNEL}")
+        asyncio.get_running_loop().add_reader(
+            self.listen_conn.fileno(), self._on_readable
+        )
+        logger.info("Listening for channel messages on %s", self.CHANNEL)
+
+    def _close_listener(self):
+        if self.listen_conn is not None:
+            asyncio.get_running_loop().remove_reader(self.listen_conn.fileno())
+            self.listen_conn.close()
+            self.listen_conn = None
+
+    def _on_readable(self):
+        try:
+            self.listen_conn.poll()
+        except psycopg2.Error:
+            logger.exception("Lost channel listener connection")
+            self._close_listener()
+            self.reconnect_task = asyncio.create_task(self._reconnect())
+            return
+        while self.listen_conn.notifies:
+            notify = self.listen_conn.notifies.pop(0)
+            try:
+                payload = json.loads(notify.payload)
+            except ValueError:
+                logger.warning("Ignoring malformed channel message")
+                continue
+            if payload.get("origin") == self.origin:
+                continue
+            if "part" in payload:
+                payload = self._reassemble(payload)
+                if payload is None:
+                    continue
+            self.inbox.put_nowait((payload["short_code"], payload["message"]))
+
+    def _reassemble(self, part: dict):
+        # Returns the whole message once its last part arrives
+        now = time.monotonic()
+        for key, (started, _) in list(self.partial.items()):
+            if now - started > self.PART_TIMEOUT:
+                logger.warning("Dropping incomplete channel message %s", key[1])
+                del self.partial[key]
+        key = (part["origin"], part["id"])
+        _, parts = self.partial.setdefault(key, (now, {}))
+        parts[part["part"]] = base64.b64decode(part["data"])
+        if len(parts) < part["parts"]:
+            return None
+        del self.partial[key]
+        return json.loads(b"".join(parts[i] for i in range(part["parts"])))
+
+    async def _reconnect(self):
+        while self.listen_conn is None:
+            await asyncio.sleep(self.RECONNECT_DELAY)
+            try:
+                self._listen()
+            except psycopg2.Error:
+                logger.exception("Failed to reconnect channel listener")
+
+    async def _receive_loop(self):
+        while True:
+            short_code, message = await self.inbox.get()
+            try:
+                await self.on_message(short_code, message)
+            except Exception:
+                logger.exception("Error handling channel message for %s", short_code)
+
+    async def _publish_loop(self):
+        while True:
+            # Send everything that queued up while the last batch was in flight
+            payloads = [await self.outbox.get()]
+            while not self.outbox.empty():
+                payloads.append(self.outbox.get_nowait())
+            try:
+                await asyncio.to_thread(self._notify, payloads)
+            except psycopg2.Error:
+                logger.exception("Failed to publish channel messages")
+                if self.publish_conn is not None:
+                    self.publish_conn.close()
+                self.publish_conn = None
+
+    def _notify(self, payloads: list[str]):
+        if self.publish_conn is None:
+            self.publish_conn = psycopg2.connect(self.dsn)
+            self.publish_conn.set_isolation_level(
+                psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT
+            )
+        with self.publish_conn.cursor() as cursor:
+            # One at a time, so a message that fails doesn't take the rest of
+            # the batch with it. In autocommit mode the connection stays usable.
+            for sent, payload in enumerate(payloads):
+                try:
+                    cursor.execute("SELECT pg_notify(%s, %s)", (self.CHANNEL, payload))
+                except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                    logger.error(
+                        "Lost publish connection, dropped %d channel messages",
+                        len(payloads) - sent,
+                    )
+                    raise
+                except psycopg2.Error:
+                    logger.exception(
+                        "Failed to publish a %d byte channel message", len(payload)
+                    )
+
+
+def make_backend(settings):
+    if settings.CHANNEL_BACKEND == "postgres":
+        return PostgresBackend(str(settings.POSTGRES_DSN))
+    return InProcessBackend()
@@ -1,22 +1,81 @@
-from faker import Faker
-from fastapi import APIRouter, HTTPException, WebSocket, status
-from sqlalchemy import select
-from sqlalchemy.orm import Session
-
-from api_types import CreateMeeting, JoinMeeting, MeetingResponse, UpdateRole
-from channel import ChannelEvent, MeetingChannels
-from database import DbSession
+import asyncio
+import functools
+import uuid
+
+from fastapi import APIRouter, HTTPException, Request, WebSocket, status
+from sqlalchemy import delete, event, insert, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from api_types import (
+    CreateMeeting,
+    CreateSimulatedParticipants,
+    JoinMeeting,
+    MeetingResponse,
+    RemoveParticipants,
+    StartLoad,
+    UpdateParticipants,
+    UpdateRole,
+)
+from cache import SingleFlight, TTLCache
+from channel import (
+    ChannelEvent,
+    EventType,
+    MeetingChannel,
+    MeetingChannels,
+)
+from config import settings
+from database import AsyncDbSession, AsyncSessionLocal
 from dependencies import CurrentUser
+from etags import conditional_response, make_etag
+from eventlog import EventLog
+from loadgen import LoadGenerator
+from metrics import (
+    CHANNEL_EVENTS,
+    DB_QUERY_DURATION,
+    LIVE_CHANNELS,
+    LIVE_WEBSOCKETS,
+    WEBSOCKET_REJECTIONS,
+)
 from models import Meeting, Participation, Role, User, gen_short_code
+from pubsub import make_backend
 
 router = APIRouter()
-meeting_channels = MeetingChannels()
-fake = Faker(["ar_AA", "en_US", "ja_JP", "zh_CN", "ru_RU", "ko_KR"])
+meeting_channels = MeetingChannels(
+    make_backend(settings), EventLog() if settings.EVENT_LOG_ENABLED else None
+)
+# Read when metrics are scraped, so they cost nothing in between
+LIVE_CHANNELS.set_function(lambda: len(meeting_channels.channels))
+LIVE_WEBSOCKETS.set_function(
+    lambda: sum(len(c.connections) for c in meeting_channels.channels.values())
+)
+# Detached Meeting rows keyed by short code. Meetings don't change once created,
+# the hooks below are there in case that ever changes.
+meeting_cache = TTLCache(
+    "meeting", settings.MEETING_CACHE_SIZE, settings.MEETING_CACHE_TTL
+)
+meeting_loads = SingleFlight()
+# Handshakes in progress, so a reconnect storm is turned away rather than queued
+websocket_handshakes = asyncio.Semaphore(settings.WS_MAX_HANDSHAKES)
+
+
+@event.listens_for(Meeting, "after_update")
+@event.listens_for(Meeting, "after_delete")
+def invalidate_cached_meeting(mapper, connection, target):
+    meeting_cache.invalidate(target.short_code)
+
+
+@functools.cache
+def fake():
+    # Only simulated participants need made up names, so Faker and its locales
+    # are loaded when the first one is created rather than on every start
+    from faker import Faker
+
+    return Faker(["ar_AA", "en_US", "ja_JP", "zh_CN", "ru_RU", "ko_KR"])
 
 
 @router.post("/api/meetings")
-def create_meeting(
-    create_meeting: CreateMeeting, current_user: CurrentUser, session: DbSession
+async def create_meeting(
+    create_meeting: CreateMeeting, current_user: CurrentUser, session: AsyncDbSession
 ):
     # TODO: validate name
     meeting = Meeting(
@@ -34,18 +93,28 @@ def create_meeting(
     session.add(meeting)
     session.add(participation)
     session.add(current_user)
-    session.commit()
-    session.refresh(meeting)
-    session.refresh(participation)
+    await session.commit()
+    await session.refresh(meeting)
+    await session.refresh(participation)
     return MeetingResponse(meeting=meeting, participation=participation)
 
 
-@router.get("/api/meetings/{short_code}")
-def get_meeting(short_code: str, current_user: CurrentUser, session: DbSession):
-    meeting = get_meeting_by_short_code(session, short_code)
-    return MeetingResponse(
-        meeting=meeting,
-        participation=get_participation(session, meeting, current_user),
+@router.get("/api/meetings/{short_code}", response_model=MeetingResponse)
+async def get_meeting(
+    short_code: str,
+    request: Request,
+    current_user: CurrentUser,
+    session: AsyncDbSession,
+):
+    meeting = await get_meeting_by_short_code(session, short_code)
+    participation = await get_participation(session, meeting, current_user)
+    etag = make_etag(
+        meeting.id, meeting.version, participation.id, participation.version
+    )
+    return conditional_response(
+        request,
+        etag,
+        lambda: MeetingResponse(meeting=meeting, participation=participation),
     )
 
 
@@ -54,12 +123,12 @@ async def join_meeting(
     short_code: str,
     join_meeting: JoinMeeting,
     current_user: CurrentUser,
-    session: DbSession,
+    session: AsyncDbSession,
 ):
-    meeting = get_meeting_by_short_code(session, short_code)
+    meeting = await get_meeting_by_short_code(session, short_code)
 
     # Check if user is already in the meeting
-    participation = get_participation(
+    participation = await get_participation(
         session, meeting, current_user, allow_missing=True
     )
     if participation:
@@ -75,10 +144,10 @@ async def join_meeting(
     current_user.last_used_name = join_meeting.user_name
     session.add(participation)
     session.add(current_user)
-    session.commit()
-    session.refresh(meeting)
-    session.refresh(participation)
-    await meeting_channels.get(meeting, session).refresh_participants(session)
+    await session.commit()
+    await session.refresh(participation)
+    channel = await meeting_channels.get(meeting)
+    await channel.add_participants([participation])
     return MeetingResponse(meeting=meeting, participation=participation)
 
 
@@ -88,23 +157,26 @@ async def update_participant_role(
     participation_id: str,
     update_role: UpdateRole,
     current_user: CurrentUser,
-    session: DbSession,
+    session: AsyncDbSession,
 ):
-    meeting = get_meeting_by_short_code(session, short_code)
+    meeting = await get_meeting_by_short_code(session, short_code)
     # Only allow host to update roles
-    participation = get_participation(session, meeting, current_user)
+    participation = await get_participation(session, meeting, current_user)
     if participation.role != Role.HOST:
         raise HTTPException(status_code=403, detail="Only hosts can update roles")
 
-    stmt = select(Participation).where(Participation.id == participation_id)
-    participant = session.scalars(stmt).first()
+    stmt = select(Participation).where(
+        Participation.id == participation_id, Participation.meeting_id == meeting.id
+    )
+    participant = (await session.scalars(stmt)).first()
     if not participant:
         raise HTTPException(status_code=404, detail="Participant not found")
 
     participant.role = update_role.role
     session.add(participant)
-    session.commit()
-    await meeting_channels.get(meeting, session).refresh_participants(session)
+    await session.commit()
+    channel = await meeting_channels.get(meeting)
+    await channel.update_participants([participant])
     return "", status.HTTP_204_NO_CONTENT
 
 
@@ -113,90 +185,301 @@ async def remove_participant(
     short_code: str,
     participation_id: str,
     current_user: CurrentUser,
-    session: DbSession,
+    session: AsyncDbSession,
 ):
-    meeting = get_meeting_by_short_code(session, short_code)
+    meeting = await get_meeting_by_short_code(session, short_code)
     # Only allow host to remove participants
-    participation = get_participation(session, meeting, current_user)
+    participation = await get_participation(session, meeting, current_user)
     if participation.role != Role.HOST:
         raise HTTPException(status_code=403, detail="Only host can remove participants")
 
-    stmt = select(Participation).where(Participation.id == participation_id)
-    participant = session.scalars(stmt).first()
+    stmt = select(Participation).where(
+        Participation.id == participation_id, Participation.meeting_id == meeting.id
+    )
+    participant = (await session.scalars(stmt)).first()
     if not participant:
         raise HTTPException(status_code=404, detail="Participant not found")
 
-    session.delete(participant)
-    session.commit()
-    await meeting_channels.get(meeting, session).refresh_participants(session)
+    await session.delete(participant)
+    await session.commit()
+    channel = await meeting_channels.get(meeting)
+    await channel.remove_participants([participant.id])
+    return "", status.HTTP_204_NO_CONTENT
+
+
+@router.patch("/api/meetings/{short_code}/participants")
+async def update_participant_roles(
+    short_code: str,
+    update_participants: UpdateParticipants,
+    current_user: CurrentUser,
+    session: AsyncDbSession,
+):
+    meeting = await get_meeting_by_short_code(session, short_code)
+    # Only allow host to update roles
+    participation = await get_participation(session, meeting, current_user)
+    if participation.role != Role.HOST:
+        raise HTTPException(status_code=403, detail="Only hosts can update roles")
+
+    ids = set(update_participants.ids)
+    stmt = (
+        update(Participation)
+        .where(Participation.meeting_id == meeting.id, Participation.id.in_(ids))
+        .values(role=update_participants.role)
+        .returning(Participation)
+    )
+    participants = list(await session.scalars(stmt))
+    # All or nothing, the session is rolled back without a commit
+    if len(participants) != len(ids):
+        raise HTTPException(status_code=404, detail="Participant not found")
+    await session.commit()
+    channel = await meeting_channels.get(meeting)
+    await channel.update_participants(participants)
+    return "", status.HTTP_204_NO_CONTENT
+
+
+@router.delete("/api/meetings/{short_code}/participants")
+async def remove_participants(
+    short_code: str,
+    remove_participants: RemoveParticipants,
+    current_user: CurrentUser,
+    session: AsyncDbSession,
+):
+    meeting = await get_meeting_by_short_code(session, short_code)
+    # Only allow host to remove participants
+    participation = await get_participation(session, meeting, current_user)
+    if participation.role != Role.HOST:
+        raise HTTPException(status_code=403, detail="Only host can remove participants")
+
+    ids = set(remove_participants.ids)
+    stmt = (
+        delete(Participation)
+        .where(Participation.meeting_id == meeting.id, Participation.id.in_(ids))
+        .returning(Participation.id)
+    )
+    removed = list(await session.scalars(stmt))
+    if len(removed) != len(ids):
+        raise HTTPException(status_code=404, detail="Participant not found")
+    await session.commit()
+    channel = await meeting_channels.get(meeting)
+    await channel.remove_participants(removed)
     return "", status.HTTP_204_NO_CONTENT
 
 
 @router.post("/api/meetings/{short_code}/simulated_participants")
-async def create_simulated_participant(
+async def create_simulated_participants(
     short_code: str,
     current_user: CurrentUser,
-    session: DbSession,
+    session: AsyncDbSession,
+    create_simulated: CreateSimulatedParticipants | None = None,
 ):
-    meeting = get_meeting_by_short_code(session, short_code)
+    meeting = await get_meeting_by_short_code(session, short_code)
 
-    participation = get_participation(session, meeting, current_user)
+    participation = await get_participation(session, meeting, current_user)
     if participation.role != Role.HOST:
         raise HTTPException(
             status_code=403, detail="Only hosts can create simulated participants"
         )
 
-    name = fake.name()
-    fake_user = User(last_used_name=name)
-    fake_participation = Participation(
-        user=fake_user,
-        meeting=meeting,
-        name=name,
-        role=Role.MEMBER,
-        simulated=True,
+    count = create_simulated.count if create_simulated else 1
+    names = [fake().name() for _ in range(count)]
+    user_ids = await session.scalars(
+        insert(User).returning(User.id, sort_by_parameter_order=True),
+        [{"last_used_name": name} for name in names],
+    )
+    participants = list(
+        await session.scalars(
+            insert(Participation).returning(Participation),
+            [
+                {
+                    "user_id": user_id,
+                    "meeting_id": meeting.id,
+                    "name": name,
+                    "role": Role.MEMBER,
+                    "simulated": True,
+                }
+                for user_id, name in zip(user_ids, names, strict=True)
+            ],
+        )
+    )
+    await session.commit()
+    channel = await meeting_channels.get(meeting)
+    await channel.add_participants(participants)
+    return {"name": names[0], "names": names}
+
+
+async def get_load_channel(short_code: str, current_user: User, session: AsyncSession):
+    if not settings.LOADGEN_ENABLED:
+        raise HTTPException(status_code=404, detail="Load generation is disabled")
+    meeting = await get_meeting_by_short_code(session, short_code)
+    participation = await get_participation(session, meeting, current_user)
+    if participation.role != Role.HOST:
+        raise HTTPException(status_code=403, detail="Only hosts can generate load")
+    return await meeting_channels.get(meeting)
+
+
+@router.post("/api/meetings/{short_code}/load")
+async def start_load(
+    short_code: str,
+    start_load: StartLoad,
+    current_user: CurrentUser,
+    session: AsyncDbSession,
+):
+    # The generator runs in this worker only, its participants and events
+    # aren't shared with other workers
+    channel = await get_load_channel(short_code, current_user, session)
+    if channel.load_generator is not None:
+        raise HTTPException(status_code=409, detail="Load is already running")
+    generator = LoadGenerator(
+        channel,
+        start_load.participants,
+        start_load.rate,
+        start_load.burst,
+        start_load.cards,
     )
+    await generator.start()
+    return "", status.HTTP_204_NO_CONTENT
 
-    session.add(fake_user)
-    session.add(fake_participation)
-    session.commit()
-    session.refresh(meeting)
-    await meeting_channels.get(meeting, session).refresh_participants(session)
-    return {"name": name}
+
+@router.get("/api/meetings/{short_code}/load")
+async def get_load_report(
+    short_code: str, current_user: CurrentUser, session: AsyncDbSession
+):
+    channel = await get_load_channel(short_code, current_user, session)
+    if channel.load_generator is None:
+        raise HTTPException(status_code=404, detail="Load is not running")
+    return channel.load_generator.report()
+
+
+@router.delete("/api/meetings/{short_code}/load")
+async def stop_load(
+    short_code: str, current_user: CurrentUser, session: AsyncDbSession
+):
+    channel = await get_load_channel(short_code, current_user, session)
+    if channel.load_generator is None:
+        raise HTTPException(status_code=404, detail="Load is not running")
+    return await channel.load_generator.stop()
 
 
 @router.websocket("/api/meetings/{short_code}/ws")
-async def meeting_websocket(websocket: WebSocket, short_code: str, session: DbSession):
-    meeting = get_meeting_by_short_code(session, short_code)
-    channel = meeting_channels.get(meeting, session)
-    await channel.add_connection(websocket)
-    await channel.send_snapshot(websocket)
+async def meeting_websocket(
+    websocket: WebSocket, short_code: str, pid: str | None = None
+):
+    if websocket_handshakes.locked():
+        WEBSOCKET_REJECTIONS.inc()
+        # Accepted first so the client sees why. Browsers report a refused
+        # handshake as a bare 1006 with no reason.
+        await websocket.accept()
+        await websocket.close(
+            code=status.WS_1013_TRY_AGAIN_LATER,
+            reason=f"retry-after={settings.WS_RETRY_AFTER:g}",
+        )
+        return
+    async with websocket_handshakes:
+        # Websockets live for hours, so only hold a database session for the
+        # handshake
+        async with AsyncSessionLocal() as session:
+            meeting = await get_meeting_by_short_code(session, short_code)
+        channel = await meeting_channels.get(meeting)
+        channel.handshakes += 1
+        try:
+            await channel.add_connection(websocket)
+        finally:
+            channel.handshakes -= 1
+        channel.send_snapshot(websocket)
+    # Bind the connecting participant's id once, so their own events are found
+    # in the roster without a lookup
+    try:
+        bound_pid = uuid.UUID(pid) if pid else None
+    except ValueError:
+        bound_pid = None
+    # Frames are read ahead into a queue, so everything that arrives while one
+    # batch is being applied is applied together as the next one
+    frames = asyncio.Queue(maxsize=settings.WS_RECEIVE_QUEUE_SIZE)
+    reader_task = asyncio.create_task(read_frames(websocket, frames))
     try:
         while True:
-            data = await websocket.receive_json()
-            event = ChannelEvent.from_payload(session, data)
-            await channel.handle_event(event)
+            batch = [await frames.get()]
+            while not frames.empty():
+                batch.append(frames.get_nowait())
+            await handle_frames(websocket, channel, bound_pid, batch)
     except Exception as e:
         print(f"Error in websocket: {e}")
         channel.remove_connection(websocket)
         raise
+    finally:
+        reader_task.cancel()
+
+
+async def read_frames(websocket: WebSocket, frames: asyncio.Queue):
+    try:
+        while True:
+            await frames.put(await websocket.receive_json())
+    except Exception as e:
+        # Handed over to be raised once the frames before it are applied
+        await frames.put(e)
+
+
+async def handle_frames(
+    websocket: WebSocket,
+    channel: MeetingChannel,
+    bound_pid: uuid.UUID | None,
+    batch: list,
+):
+    events = []
+    resync = False
+    error = None
+    for frame in batch:
+        if isinstance(frame, Exception):
+            error = frame
+            break
+        # A frame is one event, or an array of them
+        for payload in frame if isinstance(frame, list) else [frame]:
+            if (
+                isinstance(payload, dict)
+                and payload.get("event") == EventType.RESYNC.value
+            ):
+                resync = True
+                continue
+            events.append(await ChannelEvent.from_payload(channel, payload, bound_pid))
+    if events:
+        CHANNEL_EVENTS.labels("websocket").inc(len(events))
+        await channel.handle_events(events)
+    if resync:
+        channel.send_snapshot(websocket)
+    if error is not None:
+        raise error
+
+
+async def get_meeting_by_short_code(session: AsyncSession, short_code: str):
+    meeting = meeting_cache.get(short_code)
+    if meeting is None:
+        meeting = await meeting_loads.run(short_code, lambda: load_meeting(short_code))
+        if meeting is None:
+            raise HTTPException(status_code=404, detail="Unknown meeting")
+    return await session.merge(meeting, load=False)
 
 
-def get_meeting_by_short_code(session: Session, short_code: str):
-    stmt = select(Meeting).where(Meeting.short_code == short_code)
-    results = session.scalars(stmt)
-    meeting = results.first()
-    if not meeting:
-        raise HTTPException(status_code=404, detail="Unknown meeting")
+async def load_meeting(short_code: str):
+    # Runs in its own session, it's shared by every request that's waiting on it
+    async with AsyncSessionLocal() as session:
+        stmt = select(Meeting).where(Meeting.short_code == short_code)
+        with DB_QUERY_DURATION.labels("meeting").time():
+            results = await session.scalars(stmt)
+        meeting = results.first()
+        if meeting:
+            session.expunge(meeting)
+            meeting_cache.set(short_code, meeting)
     return meeting
 
 
-def get_participation(
-    session: Session, meeting: Meeting, user: User, allow_missing: bool = False
+async def get_participation(
+    session: AsyncSession, meeting: Meeting, user: User, allow_missing: bool = False
 ):
     stmt = select(Participation).where(
         Participation.meeting_id == meeting.id, Participation.user_id == user.id
     )
-    results = session.scalars(stmt)
+    with DB_QUERY_DURATION.labels("participation").time():
+        results = await session.scalars(stmt)
     participation = results.first()
     if not participation and not allow_missing:
         raise HTTPException(status_code=403, detail="You have not joined this meeting")
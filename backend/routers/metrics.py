@@ -0,0 +1,11 @@
+from fastapi import APIRouter, Response
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+
+router = APIRouter()
+
+
+# Each worker process keeps its own metrics, so with more than one worker a
+# scrape only sees whichever worker answered it
+@router.get("/api/metrics")
+def read_metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
@@ -1,13 +1,15 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, Request
 
+from api_types import UserResponse
 from database import DbSession
 from dependencies import CurrentUser
+from etags import conditional_response, make_etag
 from models import User
 
 router = APIRouter()
 
 
-@router.post("/api/me")
+@router.post("/api/me", response_model=UserResponse)
 def create_user(session: DbSession):
     user = User()
     session.add(user)
@@ -16,6 +18,9 @@ def create_user(session: DbSession):
     return user
 
 
-@router.get("/api/me")
-def read_current_user(current_user: CurrentUser):
-    return current_user
+@router.get("/api/me", response_model=UserResponse)
+def read_current_user(request: Request, current_user: CurrentUser):
+    etag = make_etag(current_user.id, current_user.version)
+    return conditional_response(
+        request, etag, lambda: UserResponse.model_validate(current_user)
+    )
@@ -0,0 +1,113 @@
+import gzip
+import hashlib
+import os
+from mimetypes import guess_type
+from pathlib import Path
+
+from fastapi import Request, Response
+from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse
+from starlette.staticfiles import NotModifiedResponse
+
+from etags import etag_matches
+
+# Preferred first. The compressed copies sit next to each file, made by
+# deploy/deploy.sh when the frontend is built.
+ENCODINGS = [("br", ".br"), ("gzip", ".gz")]
+# Vite puts a hash of each file's contents in the names of everything under
+# assets/, so they can be cached forever
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+
+def accepted_encodings(header: str) -> set[str]:
+    accepted = set()
+    for item in header.split(","):
+        name, *params = item.split(";")
+        # Only q=0 matters here, it means the encoding must not be used
+        if any(
+            param.replace(" ", "") in ("q=0", "q=0.0", "q=0.00") for param in params
+        ):
+            continue
+        accepted.add(name.strip().lower())
+    return accepted
+
+
+class PrecompressedStaticFiles(StaticFiles):
+    def file_response(
+        self,
+        full_path,
+        stat_result: os.stat_result,
+        scope,
+        status_code: int = 200,
+    ):
+        request_headers = Headers(scope=scope)
+        media_type = guess_type(str(full_path))[0] or "text/plain"
+        accepted = accepted_encodings(request_headers.get("accept-encoding", ""))
+        content_encoding = None
+        for encoding, suffix in ENCODINGS:
+            if encoding not in accepted:
+                continue
+            try:
+                stat_result = os.stat(f"{full_path}{suffix}")
+            except FileNotFoundError:
+                continue
+            full_path = f"{full_path}{suffix}"
+            content_encoding = encoding
+            break
+
+        response = FileResponse(
+            full_path,
+            status_code=status_code,
+            stat_result=stat_result,
+            media_type=media_type,
+        )
+        if content_encoding is not None:
+            response.headers["Content-Encoding"] = content_encoding
+        response.headers["Vary"] = "Accept-Encoding"
+        if self.get_path(scope).startswith("assets" + os.sep):
+            response.headers["Cache-Control"] = IMMUTABLE
+        else:
+            response.headers["Cache-Control"] = "no-cache"
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        return response
+
+
+class IndexPage:
+    # The single page app's shell, served for every page that isn't an asset.
+    # It's read once and kept in memory with its compressed copies, and always
+    # revalidated, since it's what points at the current assets.
+    def __init__(self, path: Path):
+        self.path = path
+        # Encoding to (body, ETag), with None for uncompressed
+        self.variants = None
+
+    def load(self):
+        body = self.path.read_bytes()
+        digest = hashlib.blake2b(body, digest_size=12).hexdigest()
+        self.variants = {None: (body, f'"{digest}"')}
+        for encoding, suffix in ENCODINGS:
+            compressed = self.path.with_name(self.path.name + suffix)
+            if compressed.is_file():
+                compressed_body = compressed.read_bytes()
+            elif encoding == "gzip":
+                compressed_body = gzip.compress(body, mtime=0)
+            else:
+                continue
+            self.variants[encoding] = (compressed_body, f'"{digest}-{encoding}"')
+
+    def response(self, request: Request) -> Response:
+        if self.variants is None:
+            self.load()
+        accepted = accepted_encodings(request.headers.get("accept-encoding", ""))
+        encoding = next(
+            (e for e, _ in ENCODINGS if e in accepted and e in self.variants), None
+        )
+        body, etag = self.variants[encoding]
+        headers = {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+        if etag_matches(request, etag):
+            return Response(status_code=304, headers=headers)
+        if encoding is not None:
+            headers["Content-Encoding"] = encoding
+        return Response(body, media_type="text/html", headers=headers)
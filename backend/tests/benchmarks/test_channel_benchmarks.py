@@ -0,0 +1,167 @@
+import asyncio
+import itertools
+import uuid
+import zlib
+
+import pytest
+
+from channel import CardChangeEvent, CardState, MeetingChannel, MeetingState
+from encoding import ENCODINGS
+from models import Meeting, Participation, Role
+
+SIZES = [10, 100, 1000, 5000]
+SOCKETS = [1, 100, 1000]
+
+
+def make_participants(count):
+    return [
+        Participation(
+            id=uuid.uuid4(), name=f"Participant {i}", role=Role.MEMBER, simulated=False
+        )
+        for i in range(count)
+    ]
+
+
+def card_events(participants):
+    # Each lap moves every card to a different state than the last one, so no
+    # event is skipped as a no-op
+    for state in itertools.cycle([CardState.WARM, CardState.QUESTION]):
+        for participation in participants:
+            yield CardChangeEvent(participation=participation, state=state)
+
+
+class CountingWebSocket:
+    def __init__(self, delivered, subprotocols=()):
+        self.delivered = delivered
+        self.scope = {"subprotocols": list(subprotocols)}
+
+    async def accept(self, subprotocol=None):
+        pass
+
+    async def send_text(self, text):
+        self.delivered[0] += 1
+
+    async def send_bytes(self, data):
+        self.delivered[0] += 1
+
+    async def close(self, code=1000):
+        pass
+
+
+def deflated_size(message):
+    # Raw deflate, the same as permessage-deflate without context takeover
+    if isinstance(message, str):
+        message = message.encode()
+    compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+    return len(compressor.compress(message) + compressor.flush(zlib.Z_SYNC_FLUSH))
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_apply_event(benchmark, size):
+    participants = make_participants(size)
+    state = MeetingState(participants)
+    events = card_events(participants)
+
+    def apply_event():
+        state.apply_event(next(events))
+        state.take_delta()
+
+    benchmark(apply_event)
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_set_participants(benchmark, size):
+    # A roster reload where one participant was renamed
+    participants = make_participants(size)
+    renamed = participants[:-1] + [
+        Participation(
+            id=participants[-1].id, name="Renamed", role=Role.MEMBER, simulated=False
+        )
+    ]
+    state = MeetingState(participants)
+    rosters = itertools.cycle([renamed, participants])
+
+    def set_participants():
+        state.set_participants(next(rosters))
+        state.take_delta()
+
+    benchmark(set_participants)
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_snapshot(benchmark, size):
+    state = MeetingState(make_participants(size))
+
+    benchmark(state.snapshot)
+
+
+@pytest.mark.parametrize("encoding", ENCODINGS, ids=lambda e: e.name)
+@pytest.mark.parametrize("size", SIZES)
+def test_encoded_snapshot(benchmark, size, encoding):
+    participants = make_participants(size)
+    state = MeetingState(participants)
+    for event in itertools.islice(card_events(participants), size):
+        state.apply_event(event)
+    state.take_delta()
+
+    def encoded_snapshot():
+        state._encoded_snapshots.clear()
+        return state.encoded_snapshot(encoding)
+
+    snapshot = benchmark(encoded_snapshot)
+    benchmark.extra_info["bytes"] = len(snapshot)
+    benchmark.extra_info["deflated_bytes"] = deflated_size(snapshot)
+
+
+@pytest.mark.parametrize("encoding", ENCODINGS, ids=lambda e: e.name)
+@pytest.mark.parametrize("sockets", SOCKETS)
+@pytest.mark.parametrize("size", SIZES)
+def test_broadcast_changes(benchmark, size, sockets, encoding):
+    # One card change fanned out to every socket, timed until the last one has
+    # been written
+    participants = make_participants(size)
+    meeting = Meeting(id=uuid.uuid4(), short_code="bench", name="Benchmark")
+    delivered = [0]
+    events = card_events(participants)
+    loop = asyncio.new_event_loop()
+
+    async def connect():
+        channel = MeetingChannel(meeting, participants)
+        for _ in range(sockets):
+            websocket = CountingWebSocket(delivered, [encoding.subprotocol])
+            await channel.add_connection(websocket)
+        return channel
+
+    async def broadcast():
+        delivered[0] = 0
+        channel.state.apply_event(next(events))
+        channel._broadcast_changes()
+        while delivered[0] < sockets:
+            await asyncio.sleep(0)
+
+    async def disconnect():
+        channel.close()
+        await asyncio.sleep(0)
+
+    channel = loop.run_until_complete(connect())
+    try:
+        benchmark(lambda: loop.run_until_complete(broadcast()))
+        delta = encoding.encode_delta(
+            channel.state,
+            {
+                "type": "delta",
+                "version": channel.state.version,
+                "changes": [
+                    {
+                        "op": "card",
+                        "id": str(participants[0].id),
+                        "card_state": CardState.WARM,
+                    }
+                ],
+            },
+        )
+        benchmark.extra_info["delta_bytes"] = len(delta)
+        benchmark.extra_info["deflated_delta_bytes"] = deflated_size(delta)
+    finally:
+        loop.run_until_complete(disconnect())
+        loop.close()
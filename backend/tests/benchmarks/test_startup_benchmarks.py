@@ -0,0 +1,44 @@
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parents[2]
+
+# Runs in a fresh interpreter each round, so nothing is already imported
+STARTUP_SCRIPT = """
+import json
+import time
+
+started = time.perf_counter()
+import main
+imported = time.perf_counter()
+
+from fastapi.testclient import TestClient
+
+ready = time.perf_counter()
+with TestClient(main.app) as client:
+    client.get("/api/metrics")
+    responded = time.perf_counter()
+print(json.dumps({"import": imported - started, "first_request": responded - ready}))
+"""
+
+
+def test_startup(benchmark):
+    # Import time of main:app and time from there to its first response. The
+    # benchmark itself also counts interpreter start and shutdown.
+    timings = []
+
+    def start():
+        result = subprocess.run(
+            [sys.executable, "-c", STARTUP_SCRIPT],
+            cwd=BACKEND_DIR,
+            capture_output=True,
+            check=True,
+            text=True,
+        )
+        timings.append(json.loads(result.stdout.splitlines()[-1]))
+
+    benchmark.pedantic(start, rounds=5, iterations=1)
+    for key in ["import", "first_request"]:
+        benchmark.extra_info[f"{key}_seconds"] = min(t[key] for t in timings)
@@ -1,6 +1,26 @@
 import sys
 from pathlib import Path
 
+import pytest
+
 BACKEND_DIR = Path(__file__).resolve().parents[1]
 if str(BACKEND_DIR) not in sys.path:
     sys.path.insert(0, str(BACKEND_DIR))
+
+BENCHMARKS_DIR = Path(__file__).resolve().parent / "benchmarks"
+
+
+def pytest_addoption(parser):
+    parser.addoption(
+        "--benchmarks", action="store_true", help="run the channel benchmarks"
+    )
+
+
+def pytest_collection_modifyitems(config, items):
+    # Benchmarks take a while, so they only run when asked for
+    if config.getoption("--benchmarks"):
+        return
+    skip = pytest.mark.skip(reason="needs --benchmarks")
+    for item in items:
+        if BENCHMARKS_DIR in item.path.parents:
+            item.add_marker(skip)
@@ -1,4 +1,8 @@
+import asyncio
+import subprocess
+import sys
 import uuid
+from pathlib import Path
 
 import pytest
 from fastapi.testclient import TestClient
@@ -55,3 +59,125 @@ def test_unknown_api_route_returns_not_found(client):
     response = client.get("/api/does-not-exist")
 
     assert response.status_code == 404
+
+
+def test_current_user_answers_matching_etag_with_not_modified(client):
+    from dependencies import get_current_user
+    from models import User
+
+    user = User(id=uuid.uuid4(), last_used_name="Alice", version=7)
+    app.dependency_overrides[get_current_user] = lambda: user
+
+    response = client.get("/api/me")
+    assert response.status_code == 200
+    assert response.json()["last_used_name"] == "Alice"
+    assert "version" not in response.json()
+    etag = response.headers["etag"]
+
+    response = client.get("/api/me", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+
+    user.version = 8
+    response = client.get("/api/me", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+
+
+def test_metrics_are_exposed_in_prometheus_format(client):
+    response = client.get("/api/metrics")
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert "uca_live_channels " in response.text
+    assert "uca_broadcast_duration_seconds_bucket" in response.text
+
+
+def test_websocket_frames_are_applied_as_one_batch():
+    from channel import MeetingChannel
+    from models import Meeting, Participation, Role
+    from routers.meetings import handle_frames
+
+    alice = Participation(
+        id=uuid.uuid4(), name="Alice", role=Role.HOST, simulated=False
+    )
+    meeting = Meeting(id=uuid.uuid4(), short_code="abcdef", name="Test")
+    channel = MeetingChannel(meeting, [alice])
+    batches = []
+
+    async def handle_events(events, publish=True):
+        batches.append(events)
+
+    channel.handle_events = handle_events
+    channel.send_snapshot = lambda websocket: batches.append("snapshot")
+    event = {"event": "card_change", "pid": str(alice.id)}
+    frames = [
+        {**event, "state": "warm"},
+        [{**event, "state": "cool"}, {"event": "resync"}, {**event, "state": "none"}],
+    ]
+    asyncio.run(handle_frames(None, channel, None, frames))
+
+    assert [e.state.value for e in batches[0]] == ["warm", "cool", "none"]
+    assert batches[1:] == ["snapshot"]
+
+
+def test_websocket_is_told_to_retry_when_handshakes_are_saturated(client, monkeypatch):
+    from starlette.websockets import WebSocketDisconnect
+
+    monkeypatch.setattr("routers.meetings.websocket_handshakes", asyncio.Semaphore(0))
+
+    with client.websocket_connect("/api/meetings/abcdef/ws") as websocket:
+        with pytest.raises(WebSocketDisconnect) as disconnect:
+            websocket.receive_text()
+
+    assert disconnect.value.code == 1013
+    assert disconnect.value.reason == "retry-after=5"
+
+
+def test_websocket_binds_the_participant_without_a_lookup(client, monkeypatch):
+    from sqlalchemy.orm import make_transient_to_detached
+    from starlette.websockets import WebSocketDisconnect
+
+    from channel import CardState, MeetingChannel
+    from models import Meeting, Participation, Role
+    from routers.meetings import meeting_cache, meeting_channels
+
+    alice = Participation(
+        id=uuid.uuid4(), name="Alice", role=Role.MEMBER, simulated=False
+    )
+    meeting = Meeting(id=uuid.uuid4(), short_code="bindme", name="Test")
+    make_transient_to_detached(meeting)
+    channel = MeetingChannel(meeting, [alice])
+
+    async def no_lookup(pid):
+        raise AssertionError("Unexpected participant lookup")
+
+    channel.resolve_participation = no_lookup
+    monkeypatch.setitem(meeting_channels.channels, "bindme", channel)
+    meeting_cache.set("bindme", meeting)
+    try:
+        # The server raises the disconnect once the client closes
+        with pytest.raises(WebSocketDisconnect):
+            with client.websocket_connect(
+                f"/api/meetings/bindme/ws?pid={alice.id}"
+            ) as ws:
+                ws.receive_json()
+                ws.send_json(
+                    {"event": "card_change", "pid": str(alice.id), "state": "warm"}
+                )
+                ws.receive_json()
+    finally:
+        meeting_cache.invalidate("bindme")
+
+    assert channel.state.participants[alice.id].card_state == CardState.WARM
+
+
+def test_importing_the_app_does_not_load_faker():
+    # Faker and its locales are slow to load, and only needed for simulated
+    # participants
+    script = "import sys, main; assert 'faker' not in sys.modules"
+    subprocess.run(
+        [sys.executable, "-c", script],
+        cwd=Path(__file__).resolve().parents[1],
+        check=True,
+    )
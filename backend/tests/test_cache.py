@@ -0,0 +1,54 @@
+import asyncio
+
+from cache import SingleFlight, TTLCache
+
+
+def test_entries_expire_after_ttl(monkeypatch):
+    now = 100.0
+    monkeypatch.setattr("cache.time.monotonic", lambda: now)
+    cache = TTLCache("test", maxsize=10, ttl=5)
+    cache.set("key", "value")
+
+    assert cache.get("key") == "value"
+    now = 106.0
+    assert cache.get("key") is None
+
+
+def test_least_recently_used_entry_is_dropped_when_full():
+    cache = TTLCache("test", maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+
+    assert cache.get("a") == 1
+    assert cache.get("b") is None
+    assert cache.get("c") == 3
+
+
+def test_invalidate_removes_entry():
+    cache = TTLCache("test", maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.invalidate("a")
+
+    assert cache.get("a") is None
+
+
+def test_single_flight_shares_concurrent_loads():
+    loads = []
+
+    async def load():
+        loads.append(1)
+        await asyncio.sleep(0.01)
+        return "value"
+
+    async def run():
+        flight = SingleFlight()
+        results = await asyncio.gather(*(flight.run("key", load) for _ in range(5)))
+        await asyncio.sleep(0)
+        return flight, results
+
+    flight, results = asyncio.run(run())
+    assert results == ["value"] * 5
+    assert len(loads) == 1
+    assert flight.loads == {}
@@ -0,0 +1,656 @@
+import asyncio
+import json
+import time
+import uuid
+
+import msgpack
+import pytest
+from fastapi import WebSocketException
+
+from channel import (
+    CardChangeEvent,
+    CardState,
+    ChannelEvent,
+    LowerAllCardsEvent,
+    MeetingChannel,
+    MeetingChannels,
+    MeetingState,
+    ParticipantRecord,
+)
+from config import settings
+from encoding import JSON, MSGPACK, negotiate
+from metrics import BROADCAST_COOLDOWN
+from models import Meeting, Participation, Role
+
+
+def make_participation(name, role=Role.MEMBER):
+    return Participation(id=uuid.uuid4(), name=name, role=role, simulated=False)
+
+
+@pytest.fixture
+def meeting():
+    return Meeting(id=uuid.uuid4(), short_code="abcdef", name="Test", anonymous=False)
+
+
+def test_event_resolves_participant_from_roster(meeting):
+    alice = make_participation("Alice")
+    channel = MeetingChannel(meeting, [alice])
+
+    event = asyncio.run(
+        ChannelEvent.from_payload(
+            channel,
+            {"event": "card_change", "pid": str(alice.id), "state": "warm"},
+        )
+    )
+
+    assert isinstance(event, CardChangeEvent)
+    assert event.participation == ParticipantRecord.of(alice)
+    assert event.state == CardState.WARM
+
+
+def test_event_uses_bound_participant(meeting):
+    alice = make_participation("Alice")
+    channel = MeetingChannel(meeting, [alice])
+
+    async def no_lookup(pid):
+        raise AssertionError("Unexpected participant lookup")
+
+    channel.resolve_participation = no_lookup
+    event = asyncio.run(
+        ChannelEvent.from_payload(
+            channel,
+            {"event": "card_change", "pid": str(alice.id), "state": "cool"},
+            bound_pid=alice.id,
+        )
+    )
+
+    assert event.participation is channel.state.participants[alice.id].participation
+
+
+def test_removed_participant_cannot_send_events(meeting):
+    alice = make_participation("Alice")
+    channel = MeetingChannel(meeting, [alice])
+    asyncio.run(channel.remove_participants([alice.id]))
+
+    async def send():
+        # The row is gone, so the database doesn't know them either
+        channel.resolve_participation = lambda pid: asyncio.sleep(0)
+        return await ChannelEvent.from_payload(
+            channel,
+            {"event": "card_change", "pid": str(alice.id), "state": "warm"},
+            alice.id,
+        )
+
+    with pytest.raises(WebSocketException):
+        asyncio.run(send())
+    assert alice.id not in channel.state.participants
+
+
+def test_state_emits_versioned_deltas():
+    alice = make_participation("Alice")
+    state = MeetingState([alice])
+    snapshot = state.snapshot()
+    assert snapshot["version"] == 0
+
+    state.apply_event(CardChangeEvent(participation=alice, state=CardState.QUESTION))
+    delta = state.take_delta()
+
+    assert delta["version"] == 1
+    assert delta["changes"] == [
+        {"op": "card", "id": str(alice.id), "card_state": CardState.QUESTION},
+        {"op": "question_push", "id": str(alice.id)},
+    ]
+    assert state.take_delta() is None
+
+
+def test_unchanged_card_emits_no_delta():
+    alice = make_participation("Alice")
+    state = MeetingState([alice])
+
+    state.apply_event(CardChangeEvent(participation=alice, state=CardState.NONE))
+
+    assert state.take_delta() is None
+
+
+def test_roster_changes_emit_deltas():
+    alice = make_participation("Alice")
+    bob = make_participation("Bob")
+    state = MeetingState([alice, bob])
+    renamed_alice = Participation(
+        id=alice.id, name="Alicia", role=Role.HOST, simulated=False
+    )
+
+    state.set_participants([renamed_alice])
+    changes = state.take_delta()["changes"]
+
+    assert {"op": "remove", "id": str(bob.id)} in changes
+    assert {"op": "rename", "id": str(alice.id), "name": "Alicia"} in changes
+    assert {"op": "role", "id": str(alice.id), "role": Role.HOST} in changes
+
+
+def test_single_roster_operations_keep_snapshot_order():
+    alice = make_participation("Alice")
+    bob = make_participation("Bob")
+    state = MeetingState([alice, bob])
+    carol = make_participation("Carol")
+
+    state.add_participant(carol)
+    state.update_participant(
+        Participation(id=alice.id, name="Zoe", role=Role.HOST, simulated=False)
+    )
+    state.remove_participant(bob.id)
+    changes = state.take_delta()["changes"]
+
+    assert [change["op"] for change in changes] == ["add", "rename", "role", "remove"]
+    assert [p["name"] for p in state.snapshot()["participants"]] == ["Carol", "Zoe"]
+
+
+def test_updating_an_unknown_participant_does_not_add_them():
+    state = MeetingState([make_participation("Alice")])
+    stranger = make_participation("Stranger", role=Role.HOST)
+
+    state.update_participant(stranger)
+
+    assert stranger.id not in state.participants
+    assert state.take_delta() is None
+
+
+def test_state_keeps_records_and_questions_in_raised_order():
+    alice = make_participation("Alice")
+    bob = make_participation("Bob")
+    state = MeetingState([alice, bob])
+
+    for participation, card_state in [
+        (bob, CardState.QUESTION),
+        (alice, CardState.QUESTION_WARM),
+        (bob, CardState.QUESTION_COOL),
+    ]:
+        state.apply_event(
+            CardChangeEvent(participation=participation, state=card_state)
+        )
+    assert state.snapshot()["questions"] == [str(bob.id), str(alice.id)]
+
+    state.apply_event(CardChangeEvent(participation=bob, state=CardState.WARM))
+    assert state.snapshot()["questions"] == [str(alice.id)]
+    assert isinstance(state.participants[alice.id].participation, ParticipantRecord)
+
+
+def test_host_lowers_chosen_cards_in_one_transition(meeting):
+    host = make_participation("Host", role=Role.HOST)
+    alice = make_participation("Alice")
+    bob = make_participation("Bob")
+    channel = MeetingChannel(meeting, [host, alice, bob])
+    for participation in [alice, bob]:
+        channel.state.apply_event(
+            CardChangeEvent(participation=participation, state=CardState.QUESTION)
+        )
+    channel.state.take_delta()
+
+    event = asyncio.run(
+        ChannelEvent.from_payload(
+            channel,
+            {"event": "lower_all_cards", "pid": str(host.id), "pids": [str(alice.id)]},
+        )
+    )
+    assert isinstance(event, LowerAllCardsEvent)
+    channel.state.apply_event(event)
+
+    assert channel.state.take_delta()["changes"] == [
+        {"op": "card", "id": str(alice.id), "card_state": CardState.NONE},
+        {"op": "question_pop", "id": str(alice.id)},
+    ]
+    assert channel.state.snapshot()["questions"] == [str(bob.id)]
+
+
+def test_only_hosts_can_lower_cards(meeting):
+    alice = make_participation("Alice")
+    channel = MeetingChannel(meeting, [alice])
+
+    with pytest.raises(WebSocketException):
+        asyncio.run(
+            ChannelEvent.from_payload(
+                channel, {"event": "lower_all_cards", "pid": str(alice.id)}
+            )
+        )
+
+
+def test_demoted_host_can_no_longer_lower_cards(meeting):
+    host = make_participation("Host", role=Role.HOST)
+    channel = MeetingChannel(meeting, [host])
+    demoted = Participation(id=host.id, name="Host", role=Role.MEMBER, simulated=False)
+    asyncio.run(channel.update_participants([demoted]))
+
+    with pytest.raises(WebSocketException):
+        asyncio.run(
+            ChannelEvent.from_payload(
+                channel, {"event": "lower_all_cards", "pid": str(host.id)}, host.id
+            )
+        )
+
+
+def test_state_restores_from_checkpoint_and_later_events():
+    host = make_participation("Host", role=Role.HOST)
+    alice = make_participation("Alice")
+    bob = make_participation("Bob")
+    state = MeetingState([host, alice, bob])
+    state.apply_event(CardChangeEvent(participation=alice, state=CardState.QUESTION))
+    state.apply_event(CardChangeEvent(participation=bob, state=CardState.WARM))
+    checkpoint = state.checkpoint()
+    events = [
+        CardChangeEvent(participation=bob, state=CardState.QUESTION_COOL).to_payload(),
+        LowerAllCardsEvent(participation=host, pids=frozenset([alice.id])).to_payload(),
+    ]
+
+    restored = MeetingState([host, alice, bob])
+    restored.restore(checkpoint, events)
+
+    assert checkpoint == {
+        "cards": {str(alice.id): "question", str(bob.id): "warm"},
+        "questions": [str(alice.id)],
+    }
+    assert restored.participants[alice.id].card_state == CardState.NONE
+    assert restored.participants[bob.id].card_state == CardState.QUESTION_COOL
+    assert restored.snapshot()["questions"] == [str(bob.id)]
+    assert restored.take_delta() is None
+
+
+def test_snapshot_is_sorted_and_cached_until_changed():
+    bob = make_participation("bob")
+    alice = make_participation("Alice")
+    state = MeetingState([bob, alice])
+
+    encoded = state.encoded_snapshot()
+    assert [p["name"] for p in state.snapshot()["participants"]] == ["Alice", "bob"]
+    assert state.encoded_snapshot() is encoded
+
+    state.apply_event(CardChangeEvent(participation=bob, state=CardState.WARM))
+
+    assert state.encoded_snapshot() is not encoded
+
+
+class RecordingBackend:
+    def __init__(self):
+        self.published = []
+
+    def publish(self, short_code, message):
+        self.published.append((short_code, message))
+
+
+def test_local_events_are_published_and_remote_events_are_not(meeting):
+    alice = make_participation("Alice")
+    backend = RecordingBackend()
+    channel = MeetingChannel(meeting, [alice], backend)
+
+    event = CardChangeEvent(participation=alice, state=CardState.WARM)
+    asyncio.run(channel.handle_event(event))
+    assert backend.published == [
+        (
+            "abcdef",
+            {
+                "type": "events",
+                "events": [
+                    {
+                        "event": "card_change",
+                        "pid": str(alice.id),
+                        "state": "warm",
+                    }
+                ],
+            },
+        )
+    ]
+
+    remote = {"type": "events", "events": [{**event.to_payload(), "state": "cool"}]}
+    asyncio.run(channel.handle_remote_message(remote))
+    assert len(backend.published) == 1
+    assert channel.state.participants[alice.id].card_state == CardState.COOL
+
+
+class RecordingEventLog:
+    def __init__(self):
+        self.appended = []
+        self.checkpoints = []
+
+    def append(self, meeting_id, payloads):
+        self.appended.append((meeting_id, payloads))
+
+    def checkpoint(self, meeting_id, checkpoint):
+        self.checkpoints.append((meeting_id, checkpoint))
+
+
+def test_only_the_worker_that_logs_events_checkpoints_them(meeting):
+    alice = make_participation("Alice")
+    local = MeetingChannel(meeting, [alice], RecordingBackend(), RecordingEventLog())
+    remote = MeetingChannel(meeting, [alice], RecordingBackend(), RecordingEventLog())
+
+    event = CardChangeEvent(participation=alice, state=CardState.WARM)
+    asyncio.run(local.handle_event(event))
+    _, message = local.backend.published[0]
+    asyncio.run(remote.handle_remote_message(message))
+    local.checkpoint()
+    remote.checkpoint()
+
+    assert len(local.event_log.appended) == 1
+    assert len(local.event_log.checkpoints) == 1
+    assert remote.event_log.appended == []
+    assert remote.event_log.checkpoints == []
+
+
+def test_roster_operations_are_published_and_applied_remotely(meeting):
+    alice = make_participation("Alice")
+    backend = RecordingBackend()
+    channel = MeetingChannel(meeting, [alice], backend)
+    other = MeetingChannel(meeting, [alice], RecordingBackend())
+    bob = make_participation("Bob")
+
+    async def run():
+        await channel.add_participants([bob])
+        await channel.remove_participants([alice.id])
+        for _, message in backend.published:
+            await other.handle_remote_message(message)
+
+    asyncio.run(run())
+    assert [message["op"] for _, message in backend.published] == ["add", "remove"]
+    assert list(other.state.participants) == [bob.id]
+    assert (
+        other.state.participants[bob.id].participation
+        == channel.state.participants[bob.id].participation
+    )
+    assert other.backend.published == []
+
+
+def test_roster_reload_does_not_undo_changes_made_while_it_ran(meeting):
+    alice = make_participation("Alice")
+    bob = make_participation("Bob")
+    channel = MeetingChannel(meeting, [alice], RecordingBackend())
+    loaded_at = channel.roster_loaded_at
+
+    class SlowRosterSession:
+        def __init__(self):
+            self.querying = asyncio.Event()
+            self.release = asyncio.Event()
+
+        async def scalars(self, stmt):
+            # Read before Bob joined
+            self.querying.set()
+            await self.release.wait()
+            return [alice]
+
+    async def run():
+        session = SlowRosterSession()
+        reload = asyncio.create_task(channel.refresh_participants(session))
+        await session.querying.wait()
+        await channel.add_participants([bob])
+        session.release.set()
+        await reload
+
+    asyncio.run(run())
+    assert set(channel.state.participants) == {alice.id, bob.id}
+    assert channel.roster_loaded_at == loaded_at
+
+
+def test_bulk_roster_changes_are_one_message(meeting):
+    participants = [make_participation(f"P{i}") for i in range(3)]
+    backend = RecordingBackend()
+    channel = MeetingChannel(meeting, participants, backend)
+    hosts = [
+        Participation(id=p.id, name=p.name, role=Role.HOST, simulated=False)
+        for p in participants
+    ]
+
+    asyncio.run(channel.update_participants(hosts))
+
+    assert len(backend.published) == 1
+    assert [p["role"] for p in backend.published[0][1]["participants"]] == ["host"] * 3
+    assert all(
+        pstate.participation.role == Role.HOST
+        for pstate in channel.state.participants.values()
+    )
+
+
+def test_newly_loaded_channel_takes_state_from_other_workers(meeting):
+    alice = make_participation("Alice")
+    bob = make_participation("Bob")
+    live_backend = RecordingBackend()
+    live = MeetingChannel(meeting, [alice, bob], live_backend)
+    loaded = MeetingChannel(meeting, [alice, bob], RecordingBackend())
+
+    async def run():
+        await live.handle_events(
+            [
+                CardChangeEvent(participation=bob, state=CardState.QUESTION),
+                CardChangeEvent(participation=alice, state=CardState.QUESTION),
+            ]
+        )
+        await live.handle_remote_message({"type": "sync"})
+        await loaded.handle_remote_message({"type": "sync"})
+        _, state = live_backend.published[-1]
+        await loaded.handle_remote_message(state)
+
+    asyncio.run(run())
+    assert loaded.backend.published == []
+    assert loaded.state.checkpoint() == live.state.checkpoint()
+    assert list(loaded.state.questions) == [bob.id, alice.id]
+
+
+def test_batched_events_are_one_transition_and_one_message(meeting):
+    alice = make_participation("Alice")
+    bob = make_participation("Bob")
+    backend = RecordingBackend()
+    channel = MeetingChannel(meeting, [alice, bob], backend)
+
+    events = [
+        CardChangeEvent(participation=alice, state=CardState.QUESTION),
+        CardChangeEvent(participation=bob, state=CardState.WARM),
+        CardChangeEvent(participation=alice, state=CardState.COOL),
+    ]
+    asyncio.run(channel.handle_events(events))
+
+    assert len(backend.published) == 1
+    assert len(backend.published[0][1]["events"]) == 3
+    assert channel.state.version == 1
+    assert channel.state.snapshot()["questions"] == []
+
+
+def test_broadcast_cooldown_adapts_to_fan_out_and_event_rate(meeting, monkeypatch):
+    monkeypatch.setattr(settings, "BROADCAST_COOLDOWN_MIN", 0.05)
+    monkeypatch.setattr(settings, "BROADCAST_COOLDOWN_MAX", 2)
+    monkeypatch.setattr(settings, "BROADCAST_MESSAGE_BUDGET", 5000)
+    channel = MeetingChannel(meeting, [])
+    channel.connections = dict.fromkeys(range(1000))
+    now = time.monotonic()
+
+    # A quiet meeting broadcasts straight away, however big it is
+    channel.count_events(10, now=now)
+    assert channel.broadcast_cooldown(now).total_seconds() == 0.05
+
+    # 100 events a second to 1000 sockets is over budget, so space them out
+    channel.count_events(1000, now=now)
+    assert channel.broadcast_cooldown(now).total_seconds() == 0.2
+
+    channel.connections = dict.fromkeys(range(50000))
+    assert channel.broadcast_cooldown(now).total_seconds() == 2
+
+    # The rate decays once events stop
+    later = now + 10 * MeetingChannel.EVENT_RATE_WINDOW
+    assert channel.broadcast_cooldown(later).total_seconds() == 0.05
+
+
+def test_cooldown_metric_does_not_reveal_short_codes(meeting):
+    channel = MeetingChannel(meeting, [])
+    channel.cooldown_gauge.set(0.05)
+
+    labels = [
+        sample.labels["meeting"] for sample in BROADCAST_COOLDOWN.collect()[0].samples
+    ]
+    assert str(meeting.id) in labels
+    assert meeting.short_code not in labels
+
+    channel.close()
+    labels = [
+        sample.labels["meeting"] for sample in BROADCAST_COOLDOWN.collect()[0].samples
+    ]
+    assert str(meeting.id) not in labels
+
+
+class FakeWebSocket:
+    def __init__(self, stalled=False, subprotocols=()):
+        self.scope = {"subprotocols": list(subprotocols)}
+        self.sent = []
+        self.stalled = stalled
+        self.closed = False
+
+    async def accept(self, subprotocol=None):
+        self.subprotocol = subprotocol
+
+    async def send_text(self, text):
+        if self.stalled:
+            await asyncio.Event().wait()
+        self.sent.append(json.loads(text))
+
+    async def close(self, code=1000):
+        self.closed = True
+
+
+def test_stalled_client_does_not_hold_up_broadcasts(meeting):
+    alice = make_participation("Alice")
+
+    async def run():
+        channel = MeetingChannel(meeting, [alice])
+        fast, slow = FakeWebSocket(), FakeWebSocket(stalled=True)
+        await channel.add_connection(fast)
+        await channel.add_connection(slow)
+        event = CardChangeEvent(participation=alice, state=CardState.WARM)
+        await channel.handle_event(event)
+        await asyncio.sleep(0.01)
+        return channel, fast, slow
+
+    channel, fast, slow = asyncio.run(run())
+    assert [message["type"] for message in fast.sent] == ["delta"]
+    assert slow.sent == []
+
+
+def test_full_send_queue_falls_back_to_snapshot(meeting, monkeypatch):
+    monkeypatch.setattr(settings, "WS_SEND_QUEUE_SIZE", 2)
+    alice = make_participation("Alice")
+
+    async def run():
+        channel = MeetingChannel(meeting, [alice])
+        websocket = FakeWebSocket()
+        await channel.add_connection(websocket)
+        # Queue up more deltas than fit before the writer gets to run
+        for state in [CardState.WARM, CardState.COOL, CardState.MOVE_ON]:
+            channel.state.apply_event(CardChangeEvent(participation=alice, state=state))
+            channel._broadcast_changes()
+        await asyncio.sleep(0.01)
+        return websocket
+
+    websocket = asyncio.run(run())
+    assert len(websocket.sent) == 1
+    snapshot = websocket.sent[0]
+    assert snapshot["type"] == "snapshot"
+    assert snapshot["version"] == 3
+    assert snapshot["participants"][0]["card_state"] == "move_on"
+
+
+def test_idle_channels_are_evicted(monkeypatch):
+    monkeypatch.setattr(settings, "CHANNEL_IDLE_TTL", 60)
+    channels = MeetingChannels()
+
+    async def run():
+        for short_code in ["idle", "busy"]:
+            meeting = Meeting(id=uuid.uuid4(), short_code=short_code, name=short_code)
+            channels.channels[short_code] = MeetingChannel(meeting, [])
+        await channels.channels["busy"].add_connection(FakeWebSocket())
+        channels.evict_idle(now=time.monotonic() + 120)
+
+    asyncio.run(run())
+    assert list(channels.channels) == ["busy"]
+
+
+def test_least_recently_used_idle_channel_is_evicted_over_capacity(monkeypatch):
+    monkeypatch.setattr(settings, "MAX_LIVE_CHANNELS", 2)
+    channels = MeetingChannels()
+    for short_code in ["old", "new", "newest"]:
+        meeting = Meeting(id=uuid.uuid4(), short_code=short_code, name=short_code)
+        channels.channels[short_code] = MeetingChannel(meeting, [])
+
+    channels._evict_over_capacity()
+
+    assert list(channels.channels) == ["new", "newest"]
+
+
+def test_concurrent_cold_loads_share_one_roster_query(meeting, monkeypatch):
+    queries = []
+
+    class RosterSession:
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *exc_info):
+            pass
+
+        async def scalars(self, stmt):
+            queries.append(stmt)
+            await asyncio.sleep(0.01)
+            return [make_participation("Alice")]
+
+    monkeypatch.setattr("channel.AsyncSessionLocal", RosterSession)
+    channels = MeetingChannels()
+
+    async def run():
+        return await asyncio.gather(*(channels.get(meeting) for _ in range(50)))
+
+    loaded = asyncio.run(run())
+    assert len(queries) == 1
+    assert all(channel is loaded[0] for channel in loaded)
+    assert len(loaded[0].state.participants) == 1
+
+
+def test_loaded_channel_is_kept_when_all_others_are_busy(monkeypatch):
+    monkeypatch.setattr(settings, "MAX_LIVE_CHANNELS", 1)
+
+    class EmptyRosterSession:
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *exc_info):
+            pass
+
+        async def scalars(self, stmt):
+            return []
+
+    monkeypatch.setattr("channel.AsyncSessionLocal", EmptyRosterSession)
+    channels = MeetingChannels()
+
+    async def run():
+        busy = Meeting(id=uuid.uuid4(), short_code="busy", name="busy")
+        await channels.channels.setdefault(
+            "busy", MeetingChannel(busy, [])
+        ).add_connection(FakeWebSocket())
+        joining = Meeting(id=uuid.uuid4(), short_code="joining", name="joining")
+        channels.channels["joining"] = MeetingChannel(joining, [])
+        channels.channels["joining"].handshakes += 1
+        new = Meeting(id=uuid.uuid4(), short_code="new", name="new")
+        return await channels.get(new)
+
+    channel = asyncio.run(run())
+    assert channel.meeting.short_code == "new"
+    assert list(channels.channels) == ["busy", "joining", "new"]
+
+
+def test_msgpack_encoding_uses_participant_indexes():
+    alice = make_participation("Alice")
+    state = MeetingState([alice])
+    state.apply_event(CardChangeEvent(participation=alice, state=CardState.QUESTION))
+
+    snapshot = msgpack.unpackb(state.encoded_snapshot(MSGPACK))
+    delta = msgpack.unpackb(MSGPACK.encode_delta(state, state.take_delta()))
+
+    assert snapshot == [0, 0, [[0, str(alice.id), "Alice", 1, 3]], [0]]
+    assert delta == [1, 1, [[0, 0, 3], [1, 0]]]
+
+
+def test_negotiate_prefers_msgpack_and_falls_back_to_json():
+    assert negotiate(["uca.json.v1", "uca.msgpack.v1"]) == (MSGPACK, "uca.msgpack.v1")
+    assert negotiate(["uca.json.v1"]) == (JSON, "uca.json.v1")
+    assert negotiate([]) == (JSON, None)
@@ -0,0 +1,65 @@
+import asyncio
+import uuid
+
+from config import settings
+from eventlog import EventLog
+
+
+def test_event_log_writes_buffered_rows_in_order(monkeypatch):
+    monkeypatch.setattr(settings, "EVENT_LOG_MAX_BUFFER", 3)
+    meeting_id = uuid.uuid4()
+    event_log = EventLog()
+    written = []
+
+    async def write(batch):
+        written.append(batch)
+
+    event_log._write = write
+
+    async def run():
+        event_log.append(meeting_id, [{"event": "a"}, {"event": "b"}])
+        event_log.checkpoint(meeting_id, {"cards": {}, "questions": []})
+        # Over the buffer limit, so dropped
+        event_log.append(meeting_id, [{"event": "c"}])
+        await event_log.flush()
+        await event_log.flush()
+
+    asyncio.run(run())
+    assert written == [
+        [
+            ("event", meeting_id, {"event": "a"}),
+            ("event", meeting_id, {"event": "b"}),
+            ("checkpoint", meeting_id, {"cards": {}, "questions": []}),
+        ]
+    ]
+    assert event_log.buffer == []
+
+
+def test_stopping_finishes_a_write_in_progress(monkeypatch):
+    monkeypatch.setattr(settings, "EVENT_LOG_BATCH_SIZE", 1)
+    meeting_id = uuid.uuid4()
+    event_log = EventLog()
+    written = []
+
+    async def run():
+        writing = asyncio.Event()
+        release = asyncio.Event()
+
+        async def write(batch):
+            writing.set()
+            await release.wait()
+            written.append(batch)
+
+        event_log._write = write
+        await event_log.start()
+        event_log.append(meeting_id, [{"event": "a"}])
+        await writing.wait()
+        stopped = asyncio.create_task(event_log.stop())
+        await asyncio.sleep(0)
+        release.set()
+        await stopped
+
+    asyncio.run(run())
+    assert written == [[("event", meeting_id, {"event": "a"})]]
+    assert event_log.buffer == []
+    assert event_log.flush_task is None
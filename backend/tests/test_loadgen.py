@@ -0,0 +1,38 @@
+import asyncio
+import uuid
+
+from channel import CardState, MeetingChannel
+from config import settings
+from loadgen import LoadGenerator, parse_cards
+from models import Meeting
+
+
+def test_load_generator_reports_broadcasts_and_cleans_up(monkeypatch):
+    monkeypatch.setattr(settings, "BROADCAST_COOLDOWN_MIN", 0)
+    meeting = Meeting(id=uuid.uuid4(), short_code="loadgen", name="Load test")
+
+    async def run():
+        channel = MeetingChannel(meeting, [])
+        generator = LoadGenerator(channel, participants=50, rate=500, burst=5)
+        await generator.start()
+        assert len(channel.state.participants) == 50
+        await asyncio.sleep(0.2)
+        report = await generator.stop()
+        return channel, report
+
+    channel, report = asyncio.run(run())
+    assert report.participants == 50
+    assert report.connections == 0
+    assert report.events > 0
+    assert report.broadcasts > 0
+    assert report.fanout_latency_p50_ms is not None
+    assert channel.state.participants == {}
+    assert channel.connections == {}
+    assert channel.load_generator is None
+
+
+def test_parse_cards():
+    assert parse_cards("warm=3,question=0.5") == {
+        CardState.WARM: 3,
+        CardState.QUESTION: 0.5,
+    }
@@ -0,0 +1,51 @@
+import uuid
+
+import pytest
+import sqlalchemy as sa
+from sqlalchemy.orm import Session
+
+from models import Meeting, Participation, Role, User
+
+
+class FlushedError(Exception):
+    pass
+
+
+@pytest.fixture
+def inserts():
+    # Records the INSERTs a flush sends, and stops there, as sqlite has no xmin
+    # to read back
+    engine = sa.create_engine("sqlite://")
+    statements = []
+
+    @sa.event.listens_for(engine, "before_cursor_execute")
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+        raise FlushedError
+
+    def flush(obj):
+        with Session(engine) as session:
+            session.add(obj)
+            with pytest.raises(FlushedError):
+                session.flush()
+        return statements[-1]
+
+    return flush
+
+
+@pytest.mark.parametrize(
+    "obj",
+    [
+        Meeting(short_code="abcdef", name="Standup"),
+        User(last_used_name="Alice"),
+        Participation(
+            meeting_id=uuid.uuid4(), user_id=uuid.uuid4(), name="Alice", role=Role.HOST
+        ),
+    ],
+)
+def test_inserts_leave_out_and_read_back_xmin(inserts, obj):
+    insert, returning = inserts(obj).split(" RETURNING ")
+
+    assert insert.startswith("INSERT")
+    assert "xmin" not in insert
+    assert "xmin" in returning
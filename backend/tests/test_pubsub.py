@@ -0,0 +1,86 @@
+import asyncio
+import json
+
+import psycopg2
+
+from pubsub import PostgresBackend
+
+
+def test_large_messages_are_sent_in_parts_and_reassembled():
+    sender = PostgresBackend("postgresql://unused")
+    receiver = PostgresBackend("postgresql://unused")
+    message = {"type": "events", "events": [{"pid": str(i)} for i in range(2000)]}
+
+    sender.publish("abcdef", message)
+    payloads = []
+    while not sender.outbox.empty():
+        payloads.append(sender.outbox.get_nowait())
+
+    assert len(payloads) > 1
+    assert all(len(payload) < 8000 for payload in payloads)
+    results = [receiver._reassemble(json.loads(payload)) for payload in payloads]
+    assert results[:-1] == [None] * (len(payloads) - 1)
+    assert results[-1]["message"] == message
+    assert receiver.partial == {}
+
+
+def test_failed_notify_does_not_drop_the_rest_of_the_batch():
+    sent = []
+
+    class Cursor:
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc_info):
+            pass
+
+        def execute(self, sql, params):
+            if params[1] == "too big":
+                raise psycopg2.DataError("payload string too long")
+            sent.append(params[1])
+
+    class Connection:
+        def cursor(self):
+            return Cursor()
+
+    backend = PostgresBackend("postgresql://unused")
+    backend.publish_conn = Connection()
+    asyncio.run(asyncio.to_thread(backend._notify, ["first", "too big", "last"]))
+
+    assert sent == ["first", "last"]
+
+
+def test_received_messages_are_handled_one_at_a_time_in_order():
+    handled = []
+
+    class Notify:
+        def __init__(self, index):
+            self.payload = json.dumps(
+                {"origin": "other", "short_code": "abcdef", "message": index}
+            )
+
+    class Connection:
+        notifies = [Notify(i) for i in range(3)]
+
+        def poll(self):
+            pass
+
+    async def on_message(short_code, message):
+        handled.append(("start", message))
+        # The first one waits on the database, the rest must wait for it
+        await asyncio.sleep(0.01 if message == 0 else 0)
+        handled.append(("end", message))
+
+    async def run():
+        backend = PostgresBackend("postgresql://unused")
+        backend.on_message = on_message
+        backend.listen_conn = Connection()
+        backend.receive_task = asyncio.create_task(backend._receive_loop())
+        backend._on_readable()
+        while not backend.inbox.empty():
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.02)
+        backend.receive_task.cancel()
+
+    asyncio.run(run())
+    assert handled == [(kind, i) for i in range(3) for kind in ("start", "end")]
@@ -0,0 +1,60 @@
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+
+from static_files import IndexPage, PrecompressedStaticFiles, accepted_encodings
+
+
+def make_client(directory):
+    app = FastAPI()
+    app.mount("/static", PrecompressedStaticFiles(directory=directory), name="static")
+    index_page = IndexPage(directory / "index.html")
+
+    @app.get("/{full_path:path}")
+    def index(request: Request):
+        return index_page.response(request)
+
+    return TestClient(app)
+
+
+def test_accepted_encodings_skips_refused_ones():
+    assert accepted_encodings("gzip, deflate, br;q=0") == {"gzip", "deflate"}
+
+
+def test_precompressed_assets_are_served_by_accept_encoding(tmp_path):
+    (tmp_path / "assets").mkdir()
+    (tmp_path / "assets" / "app-abc123.js").write_text("console.log('hi')")
+    (tmp_path / "assets" / "app-abc123.js.br").write_bytes(b"brotli bytes")
+    client = make_client(tmp_path)
+
+    response = client.get(
+        "/static/assets/app-abc123.js", headers={"Accept-Encoding": "gzip, br"}
+    )
+    assert response.headers["content-encoding"] == "br"
+    assert response.headers["content-type"].startswith("text/javascript")
+    assert "immutable" in response.headers["cache-control"]
+
+    response = client.get(
+        "/static/assets/app-abc123.js", headers={"Accept-Encoding": "identity"}
+    )
+    assert "content-encoding" not in response.headers
+    assert response.text == "console.log('hi')"
+
+
+def test_index_page_is_compressed_and_revalidated(tmp_path):
+    (tmp_path / "index.html").write_text("<html>app</html>")
+    client = make_client(tmp_path)
+
+    response = client.get("/meetings/abcdef", headers={"Accept-Encoding": "gzip"})
+    assert response.status_code == 200
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.text == "<html>app</html>"
+    assert response.headers["cache-control"] == "no-cache"
+
+    response = client.get(
+        "/",
+        headers={
+            "Accept-Encoding": "gzip",
+            "If-None-Match": response.headers["etag"],
+        },
+    )
+    assert response.status_code == 304
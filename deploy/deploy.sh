@@ -19,6 +19,12 @@ npm run build
 cd ../backend
 rm -rf static
 cp -r ../frontend/build/client static
+# Compressed copies of everything compressible, served to clients that accept
+# them so the server never compresses on the fly
+find static -type f \( -name '*.html' -o -name '*.js' -o -name '*.css' \
+  -o -name '*.svg' -o -name '*.json' -o -name '*.txt' \) \
+  -exec gzip -9 --keep --force {} \; \
+  -exec brotli -q 11 --keep --force {} \;
 
 # Setup python environment
 
@@ -12,4 +12,11 @@ source ./.venv/bin/activate
 
 echo "Starting FastAPI server" >> /var/log/uca_meetings/init.log
 
-fastapi run main.py --port 80 > /var/log/uca_meetings/stdout.log 2> /var/log/uca_meetings/stderr.log
+# UCA_MEETINGS_WORKERS and UCA_MEETINGS_WS_DEFLATE come from .env, which the
+# service loads as its environment. More than one worker needs
+# UCA_MEETINGS_CHANNEL_BACKEND=postgres there too.
+# Uvicorn is run directly so websocket compression can be switched off.
+uvicorn main:app --host 0.0.0.0 --port 80 \
+  --workers "${UCA_MEETINGS_WORKERS:-1}" \
+  --ws-per-message-deflate "${UCA_MEETINGS_WS_DEFLATE:-true}" \
+  > /var/log/uca_meetings/stdout.log 2> /var/log/uca_meetings/stderr.log
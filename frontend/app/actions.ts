@@ -228,8 +228,46 @@ export const changeRole = async (
   }
 }
 
-export const createSimulatedParticipant = async (
+export const changeRoles = async (
   shortCode: string,
+  participationIds: string[],
+  role: Role,
+): Promise<any> => {
+  try {
+    const response = await fetch(urlFor(`meetings/${shortCode}/participants`), {
+      method: "PATCH",
+      headers: await defaultHeaders(),
+      body: JSON.stringify({ ids: participationIds, role: role }),
+    })
+
+    return await handleResponse(response)
+  } catch (error: any) {
+    console.error("Error updating participants:", error)
+    return new APIErrorResponse(error.message)
+  }
+}
+
+export const removeParticipants = async (
+  shortCode: string,
+  participationIds: string[],
+): Promise<any> => {
+  try {
+    const response = await fetch(urlFor(`meetings/${shortCode}/participants`), {
+      method: "DELETE",
+      headers: await defaultHeaders(),
+      body: JSON.stringify({ ids: participationIds }),
+    })
+
+    return await handleResponse(response)
+  } catch (error: any) {
+    console.error("Error removing participants:", error)
+    return new APIErrorResponse(error.message)
+  }
+}
+
+export const createSimulatedParticipants = async (
+  shortCode: string,
+  count: number = 1,
 ): Promise<any> => {
   try {
     const response = await fetch(
@@ -237,12 +275,13 @@ export const createSimulatedParticipant = async (
       {
         method: "POST",
         headers: await defaultHeaders(),
+        body: JSON.stringify({ count: count }),
       },
     )
 
     return await handleResponse(response)
   } catch (error: any) {
-    console.error("Error creating simulated participant:", error)
+    console.error("Error creating simulated participants:", error)
     return new APIErrorResponse(error.message)
   }
 }
@@ -3,12 +3,53 @@ import type { Participation, Role } from "~/actions"
 import RobustWebSocket from "robust-websocket"
 import type { CardState } from "~/components/cardState"
 
-export function connectWebSocket(shortCode: string): WebSocket {
+function retryAfter(reason: string): number {
+  const match = /retry-after=([\d.]+)/.exec(reason)
+  return match ? parseFloat(match[1]) : 5
+}
+
+// The server's order: lower-cased name by code point, then id. Plain string
+// comparison goes by UTF-16 code unit, which differs for characters outside
+// the Basic Multilingual Plane, and localeCompare by locale.
+function compareCodePoints(a: string, b: string): number {
+  const left = Array.from(a)
+  const right = Array.from(b)
+  for (let i = 0; i < Math.min(left.length, right.length); i++) {
+    const diff = left[i].codePointAt(0)! - right[i].codePointAt(0)!
+    if (diff != 0) return diff
+  }
+  return left.length - right.length
+}
+
+function compareParticipants(
+  a: { id: string; name: string },
+  b: { id: string; name: string },
+): number {
+  return (
+    compareCodePoints(a.name.toLowerCase(), b.name.toLowerCase()) ||
+    compareCodePoints(a.id, b.id)
+  )
+}
+
+export function connectWebSocket(
+  shortCode: string,
+  participation: Participation,
+): WebSocket {
   const protocol = window.location.protocol === "https:" ? "wss" : "ws"
-  const url = `${protocol}://${window.location.host}/api/meetings/${shortCode}/ws`
+  const url = `${protocol}://${window.location.host}/api/meetings/${shortCode}/ws?pid=${participation.id}`
   const socket = new RobustWebSocket(url, null, {
-    shouldReconnect: (_event: any, ws: RobustWebSocket) =>
-      ws.reconnects <= 3 && 0,
+    shouldReconnect: (event: CloseEvent, ws: RobustWebSocket) => {
+      // The server is busy, so come back when it says, spread over twice that
+      // so everyone it turned away doesn't return at once
+      if (event.code === 1013) {
+        return retryAfter(event.reason) * 1000 * (1 + Math.random())
+      }
+      if (ws.reconnects > 3) {
+        return false
+      }
+      // Jittered backoff, so a server restart isn't met by every client at once
+      return Math.random() * 1000 * 2 ** ws.reconnects
+    },
   })
   console.log("Connecting to WebSocket", socket)
 
@@ -27,8 +68,12 @@ export function connectWebSocket(shortCode: string): WebSocket {
 enum EventType {
   CardChange = "card_change",
   LowerAllCards = "lower_all_cards",
+  Resync = "resync",
 }
 
+// Events sent in the same tick are held here and go out together in one frame
+const pendingEvents = new WeakMap<WebSocket, any[]>()
+
 async function sendEvent(
   websocket: WebSocket,
   participation: Participation,
@@ -36,8 +81,24 @@ async function sendEvent(
   params: any,
 ) {
   const msg = { pid: participation.id, event: event, ...params }
-  console.log("Sending message", msg)
-  websocket.send(JSON.stringify(msg))
+  let pending = pendingEvents.get(websocket)
+  if (!pending) {
+    const batch: any[] = []
+    pendingEvents.set(websocket, batch)
+    queueMicrotask(() => {
+      pendingEvents.delete(websocket)
+      sendEvents(websocket, batch)
+    })
+    pending = batch
+  }
+  pending.push(msg)
+}
+
+// Sends several events as one array, which the server applies as a single
+// change to the meeting
+export function sendEvents(websocket: WebSocket, msgs: any[]) {
+  console.log("Sending messages", msgs)
+  websocket.send(JSON.stringify(msgs.length === 1 ? msgs[0] : msgs))
 }
 
 export async function sendCardChangeEvent(
@@ -50,18 +111,98 @@ export async function sendCardChangeEvent(
   })
 }
 
+// Hosts only. Lowers the cards of the given participants, or of everyone if
+// no ids are given, as one change to the meeting.
+export async function sendLowerCardsEvent(
+  websocket: WebSocket,
+  participation: Participation,
+  pids?: string[],
+) {
+  sendEvent(
+    websocket,
+    participation,
+    EventType.LowerAllCards,
+    pids ? { pids: pids } : {},
+  )
+}
+
+// Ask the server for a fresh snapshot after missing a delta
+export function sendResync(websocket: WebSocket) {
+  console.log("Requesting resync")
+  websocket.send(JSON.stringify({ event: EventType.Resync }))
+}
+
 // The meeting snapshot data structure send on the websocket
 export class MeetingSnapshot {
+  version: number
   participants: Array<MeetingParticipant>
   questions: string[]
 
   constructor(websocketData: any) {
+    this.version = websocketData.version
     this.participants = websocketData.participants.map(
       (p: any) => new MeetingParticipant(p.id, p.name, p.card_state, p.role),
     )
     this.questions = websocketData.questions
   }
 
+  // Returns a new snapshot with a delta message applied. Changes are
+  // idempotent so re-applying ones already in the snapshot is harmless.
+  applyDelta(delta: any): MeetingSnapshot {
+    const participants = new Map(
+      this.participants.map((p) => [
+        p.id,
+        new MeetingParticipant(p.id, p.name, p.cardState, p.role),
+      ]),
+    )
+    let questions = [...this.questions]
+    for (const change of delta.changes) {
+      const participant = participants.get(change.id)
+      switch (change.op) {
+        case "add": {
+          const p = change.participant
+          participants.set(
+            p.id,
+            new MeetingParticipant(p.id, p.name, p.card_state, p.role),
+          )
+          break
+        }
+        case "remove":
+          participants.delete(change.id)
+          questions = questions.filter((q) => q != change.id)
+          break
+        case "rename":
+          if (participant) participant.name = change.name
+          break
+        case "role":
+          if (participant) participant.role = change.role
+          break
+        case "card":
+          if (participant) participant.cardState = change.card_state
+          break
+        case "question_push":
+          questions = questions.filter((q) => q != change.id)
+          questions.push(change.id)
+          break
+        case "question_pop":
+          questions = questions.filter((q) => q != change.id)
+          break
+      }
+    }
+    return new MeetingSnapshot({
+      version: delta.version,
+      participants: [...participants.values()]
+        .sort(compareParticipants)
+        .map((p) => ({
+          id: p.id,
+          name: p.name,
+          card_state: p.cardState,
+          role: p.role,
+        })),
+      questions: questions,
+    })
+  }
+
   getParticipant(pid: string) {
     return this.participants.find((p) => p.id == pid)
   }
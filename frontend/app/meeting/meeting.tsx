@@ -1,9 +1,11 @@
 import { Container, Grid } from "@mui/material"
 import type { Route } from "../routes/+types/meeting"
 import { useLoaderData } from "react-router"
-import { useEffect, useState } from "react"
+import { useEffect, useRef, useState } from "react"
 import {
   sendCardChangeEvent,
+  sendLowerCardsEvent,
+  sendResync,
   MeetingSnapshot,
   connectWebSocket,
   MeetingParticipant,
@@ -15,13 +17,17 @@ import CardSelect from "./cardSelect"
 import Summary from "./summary"
 import {
   APIErrorResponse,
-  changeRole,
-  createSimulatedParticipant,
-  leaveMeeting,
+  changeRoles,
+  createSimulatedParticipants,
+  removeParticipants,
   MeetingResponse,
   Role,
 } from "~/actions"
 
+function participantNames(participants: MeetingParticipant[]) {
+  return participants.map((participant) => participant.name).join(", ")
+}
+
 export default function Meeting(params: Route.LoaderArgs) {
   const { meetingData } = useLoaderData() as { meetingData: MeetingResponse }
   const { shortCode } = meetingData.meeting
@@ -29,6 +35,7 @@ export default function Meeting(params: Route.LoaderArgs) {
   const [websocket, setWebsocket] = useState<WebSocket>()
   const [meetingSnapshot, setMeetingSnapshot] =
     useState<MeetingSnapshot | null>()
+  const snapshotRef = useRef<MeetingSnapshot | null>(null)
 
   const [FlashComponent, setFlash] = useFlash()
 
@@ -36,11 +43,30 @@ export default function Meeting(params: Route.LoaderArgs) {
     const onMessage = (event: MessageEvent) => {
       const data = JSON.parse(event.data)
       console.log("Received message", data)
-      setMeetingSnapshot(new MeetingSnapshot(data))
+      const current = snapshotRef.current
+      let next: MeetingSnapshot
+      if (data.type === "snapshot") {
+        next = new MeetingSnapshot(data)
+      } else if (data.type === "delta") {
+        // Deltas sent before our snapshot arrived are already included in it
+        if (!current || data.version <= current.version) return
+        if (data.version !== current.version + 1) {
+          sendResync(newWebsocket)
+          return
+        }
+        next = current.applyDelta(data)
+      } else {
+        return
+      }
+      snapshotRef.current = next
+      setMeetingSnapshot(next)
     }
 
     console.log("Setting up WebSocket", params)
-    const newWebsocket = connectWebSocket(params.params.shortCode)
+    const newWebsocket = connectWebSocket(
+      params.params.shortCode,
+      meetingData.participation,
+    )
     setWebsocket(newWebsocket)
 
     const syncCardData = () => {
@@ -104,41 +130,45 @@ export default function Meeting(params: Route.LoaderArgs) {
                 currentParticipation={meetingData.participation}
                 onLowerCards={async (participants: MeetingParticipant[]) => {
                   if (websocket) {
-                    for (const participant of participants) {
-                      sendCardChangeEvent(websocket, participant, CardState.None)
-                    }
+                    sendLowerCardsEvent(
+                      websocket,
+                      meetingData.participation,
+                      participants.map((participant) => participant.id),
+                    )
                   }
                 }}
                 onMakeHosts={async (participants: MeetingParticipant[]) => {
-                  for (const participant of participants) {
-                    const response = await changeRole(
-                      shortCode,
-                      participant.id,
-                      Role.Host,
-                    )
-                    setFlashFromResponse(
-                      response,
-                      `${participant.name} is now a host`,
-                      `Failed to make ${participant.name} a host`,
-                    )
-                  }
+                  const response = await changeRoles(
+                    shortCode,
+                    participants.map((participant) => participant.id),
+                    Role.Host,
+                  )
+                  setFlashFromResponse(
+                    response,
+                    `${participantNames(participants)} made host`,
+                    `Failed to make ${participantNames(participants)} host`,
+                  )
                 }}
                 onKickParticipants={async (participants: MeetingParticipant[]) => {
-                  for (const participant of participants) {
-                    const response = await leaveMeeting(shortCode, participant.id)
-                    setFlashFromResponse(
-                      response,
-                      `${participant.name} has been removed`,
-                      `Failed to remove ${participant.name}`,
-                    )
-                  }
+                  const response = await removeParticipants(
+                    shortCode,
+                    participants.map((participant) => participant.id),
+                  )
+                  setFlashFromResponse(
+                    response,
+                    `${participantNames(participants)} removed`,
+                    `Failed to remove ${participantNames(participants)}`,
+                  )
                 }}
-                onAddSimulatedParticipant={async () => {
-                  const response = await createSimulatedParticipant(shortCode)
+                onAddSimulatedParticipants={async (count: number) => {
+                  const response = await createSimulatedParticipants(
+                    shortCode,
+                    count,
+                  )
                   setFlashFromResponse(
                     response,
-                    `${response.name} created`,
-                    "Failed to create simulated participant",
+                    `${response.names?.join(", ")} created`,
+                    "Failed to create simulated participants",
                   )
                 }}
               />
@@ -32,7 +32,7 @@ type SummaryProps = {
   onKickParticipants: (
     participants: MeetingParticipant[],
   ) => Promise<void> | void
-  onAddSimulatedParticipant: () => Promise<void> | void
+  onAddSimulatedParticipants: (count: number) => Promise<void> | void
 }
 
 type ActionType = "lower" | "makeHost" | "kick"
@@ -53,7 +53,7 @@ export default function Summary({
   onLowerCards,
   onMakeHosts,
   onKickParticipants,
-  onAddSimulatedParticipant,
+  onAddSimulatedParticipants,
 }: SummaryProps) {
   const [expandedSections, setExpandedSections] = useState<
     Record<string, boolean>
@@ -287,9 +287,18 @@ export default function Summary({
             <Button variant="outlined" onClick={() => openDialog("kick")}>
               Remove
             </Button>
-            <Button variant="outlined" onClick={onAddSimulatedParticipant}>
+            <Button
+              variant="outlined"
+              onClick={() => onAddSimulatedParticipants(1)}
+            >
               Add simulated participant
             </Button>
+            <Button
+              variant="outlined"
+              onClick={() => onAddSimulatedParticipants(10)}
+            >
+              Add 10
+            </Button>
           </Stack>
         </Box>
       )}